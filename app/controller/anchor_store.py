@@ -0,0 +1,98 @@
+import importlib
+import json
+import os
+import time
+import urllib.request
+from controller.sqlite_transaction import connect
+
+# Stay below SQLITE_MAX_VARIABLE_NUMBER of older SQLite builds
+LOOKUP_CHUNK_SIZE = 500
+
+
+class AnchorStore:
+    """
+    Merkle roots of known transactions in the local SQLite database. cert_issuer_api records the root of every batch
+    it issues, cert_tools_api reads them when verifying, so certificates of our own transactions are verified without
+    asking the chain. Roots confirmed by a chain lookup are added as well.
+    """
+
+    def __init__(self, db_location):
+        self.db_location = db_location
+        with connect(self.db_location) as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS anchors (
+                    tx_id TEXT PRIMARY KEY,
+                    merkle_root TEXT,
+                    chain TEXT,
+                    created REAL)""")
+
+    def add(self, tx_id, merkle_root, chain=None):
+        with connect(self.db_location) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO anchors (tx_id, merkle_root, chain, created) VALUES (?, ?, ?, ?)",
+                (normalize_hex(tx_id), normalize_hex(merkle_root), chain, time.time()))
+
+    def lookup(self, tx_ids):
+        """ Returns tx_id -> merkle root for the known transactions of the list. """
+        found = {}
+        unique_tx_ids = list(dict.fromkeys(normalize_hex(tx_id) for tx_id in tx_ids))
+        with connect(self.db_location) as connection:
+            for start in range(0, len(unique_tx_ids), LOOKUP_CHUNK_SIZE):
+                chunk = unique_tx_ids[start:start + LOOKUP_CHUNK_SIZE]
+                rows = connection.execute(
+                    "SELECT tx_id, merkle_root FROM anchors WHERE tx_id IN (%s)" % ','.join('?' * len(chunk)),
+                    chunk).fetchall()
+                for row in rows:
+                    found[row["tx_id"]] = row["merkle_root"]
+        return found
+
+
+class JsonRpcChainLookup:
+    """
+    Default chain lookup, returns the input data of the transaction from an Ethereum JSON-RPC node such as the
+    bloxberg RPC. The Merkle root is an argument of the issuing contract call, so it is part of the input.
+    """
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self, tx_id):
+        body = json.dumps({"jsonrpc": "2.0", "id": 1, "method": "eth_getTransactionByHash",
+                           "params": [tx_id if tx_id.startswith('0x') else '0x' + tx_id]}).encode('utf-8')
+        request = urllib.request.Request(self.url, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            transaction = json.load(response).get("result")
+        if transaction is None:
+            return None
+        return transaction.get("input")
+
+
+def is_anchored(transaction_input, merkle_root):
+    """ Whether the input data returned by a chain lookup contains the Merkle root. """
+    return transaction_input is not None and normalize_hex(merkle_root) in normalize_hex(transaction_input)
+
+
+def normalize_hex(value):
+    value = value.lower()
+    return value[2:] if value.startswith('0x') else value
+
+
+def get_chain_lookup():
+    """
+    Chain lookup for transactions missing from the store: ANCHOR_CHAIN_LOOKUP names a callable 'module:function'
+    taking a transaction id and returning its input data or None, otherwise ANCHOR_RPC_URL enables the JSON-RPC
+    lookup. Without either, unknown transactions are reported as unverified.
+    """
+    plugin = os.getenv("ANCHOR_CHAIN_LOOKUP")
+    if plugin:
+        module_name, _, function_name = plugin.partition(':')
+        return getattr(importlib.import_module(module_name), function_name)
+    rpc_url = os.getenv("ANCHOR_RPC_URL")
+    if rpc_url:
+        return JsonRpcChainLookup(rpc_url, timeout=float(os.getenv("ANCHOR_RPC_TIMEOUT_SECONDS", "10")))
+    return None
+
+
+def get_anchor_db_location():
+    return os.getenv("ANCHOR_DB_LOCATION", "sqlite.db")
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import os
+import shutil
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Marker written into every workspace, the sweeper never touches directories without it.
+OWNER_FILE = '.batch_workspace'
+
+
+class BatchWorkspace:
+    """
+    Directory owned by a single batch, created as <root>/<batch_id>. Everything the batch writes goes below it, so
+    cleanup only ever removes files of this batch and concurrent batches can share the same root.
+    """
+
+    def __init__(self, root, batch_id=None):
+        self.batch_id = batch_id or str(uuid.uuid4())
+        self.path = os.path.join(root, self.batch_id)
+        os.makedirs(self.path)
+        with open(os.path.join(self.path, OWNER_FILE), 'w') as f:
+            f.write(str(os.getpid()))
+
+    def subdir(self, name):
+        path = os.path.join(self.path, name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.cleanup()
+
+
+def is_valid_batch_id(batch_id):
+    try:
+        return str(uuid.UUID(batch_id)) == batch_id
+    except (TypeError, ValueError):
+        return False
+
+
+def sweep_orphans(roots, max_age_seconds):
+    """ Removes workspaces below the given roots that are older than max_age_seconds, e.g. left by a killed worker. """
+    removed = 0
+    cutoff = time.time() - max_age_seconds
+    for root in roots:
+        if not os.path.isdir(root):
+            continue
+        for entry in os.scandir(root):
+            owner_file = os.path.join(entry.path, OWNER_FILE)
+            try:
+                if not entry.is_dir() or os.path.getmtime(owner_file) > cutoff:
+                    continue
+            except OSError:
+                continue
+            logger.info('Removing orphaned batch workspace %s', entry.path)
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+async def run_sweeper(roots, max_age_seconds, interval_seconds):
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, sweep_orphans, roots, max_age_seconds)
+        except Exception as e:
+            logger.warning('Sweeping batch workspaces failed: %s', e)
+        await asyncio.sleep(interval_seconds)
+
+
+def start_sweeper(roots):
+    max_age_seconds = float(os.getenv("WORKSPACE_MAX_AGE_SECONDS", "3600"))
+    interval_seconds = float(os.getenv("WORKSPACE_SWEEP_INTERVAL_SECONDS", "600"))
+    return asyncio.get_event_loop().create_task(run_sweeper(roots, max_age_seconds, interval_seconds))
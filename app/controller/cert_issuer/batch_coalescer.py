@@ -0,0 +1,66 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BatchCoalescer:
+    """
+    Gathers certificates from concurrent requests that share a key (recipient and token URI) and issues them as one
+    Merkle batch. A batch is flushed once `window_seconds` passed since its first request or it reached `max_batch_size`
+    certificates. Every caller receives the result of the shared issuance and picks its own certificates out of it.
+    """
+
+    def __init__(self, issue_batch, window_seconds=0.0, max_batch_size=1000):
+        self.issue_batch = issue_batch
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self.pending = {}
+
+    async def submit(self, key, items):
+        if self.window_seconds <= 0:
+            return await self.issue_batch(key, list(items))
+
+        group = self.pending.get(key)
+        if group is not None and len(group.items) + len(items) > self.max_batch_size:
+            self._flush(key)
+            group = None
+        if group is None:
+            group = _PendingBatch()
+            self.pending[key] = group
+            group.timer = asyncio.get_event_loop().call_later(self.window_seconds, self._flush, key)
+
+        future = asyncio.get_event_loop().create_future()
+        group.items.extend(items)
+        group.futures.append(future)
+        if len(group.items) >= self.max_batch_size:
+            self._flush(key)
+        return await future
+
+    def _flush(self, key):
+        group = self.pending.pop(key, None)
+        if group is None:
+            return
+        group.timer.cancel()
+        logger.info('Issuing coalesced batch of %d certificates from %d requests', len(group.items),
+                    len(group.futures))
+        asyncio.ensure_future(self._issue(key, group))
+
+    async def _issue(self, key, group):
+        try:
+            result = await self.issue_batch(key, group.items)
+        except Exception as e:
+            for future in group.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future in group.futures:
+            if not future.done():
+                future.set_result(result)
+
+
+class _PendingBatch:
+    def __init__(self):
+        self.items = []
+        self.futures = []
+        self.timer = None
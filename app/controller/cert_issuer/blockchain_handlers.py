@@ -0,0 +1,111 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PooledHandlers:
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.checked = time.monotonic()
+
+
+class BlockchainHandlerPool:
+    """
+    Keeps instantiated (certificate_batch_handler, transaction_handler, connector) sets for the whole worker instead of
+    rebuilding connector, contract and transaction handler for every batch. A set is only used by one issuance at a
+    time, since the certificate batch handler holds the batch being issued, so at most `size` sets are built.
+
+    Idle sets are health checked before reuse once `health_check_seconds` passed, and sets whose issuance failed are
+    dropped, so a lost RPC connection results in fresh handlers.
+    """
+
+    def __init__(self, factory, size, health_check_seconds=60, nonce_manager=None):
+        self.factory = factory
+        self.size = size
+        self.health_check_seconds = health_check_seconds
+        self.nonce_manager = nonce_manager
+        self.idle = []
+        self.created = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while not self.idle and self.created >= self.size:
+                self.condition.wait()
+            if self.idle:
+                pooled = self.idle.pop()
+            else:
+                self.created += 1
+                pooled = None
+        if pooled is not None and self._is_healthy(pooled):
+            return pooled
+        try:
+            return self._build()
+        except Exception:
+            with self.condition:
+                self.created -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, pooled, healthy=True):
+        with self.condition:
+            if healthy:
+                self.idle.append(pooled)
+            else:
+                self.created -= 1
+                if self.nonce_manager is not None:
+                    self.nonce_manager.reset()
+            self.condition.notify()
+
+    def _build(self):
+        handlers = self.factory()
+        connector = handlers[2]
+        if self.nonce_manager is not None:
+            self.nonce_manager.wrap(connector)
+        return PooledHandlers(handlers)
+
+    def _is_healthy(self, pooled):
+        if time.monotonic() - pooled.checked < self.health_check_seconds:
+            return True
+        transaction_handler = pooled.handlers[1]
+        try:
+            if hasattr(transaction_handler, 'ensure_balance'):
+                transaction_handler.ensure_balance()
+        except Exception as e:
+            logger.warning('Blockchain handlers failed the health check, rebuilding: %s', e)
+            return False
+        pooled.checked = time.monotonic()
+        return True
+
+
+class NonceManager:
+    """
+    Hands out increasing nonces for transactions sent concurrently from this worker. The connector is still asked for
+    the account nonce, but two in-process transactions can no longer receive the same one while the first is pending.
+    Transactions from other workers are only accounted for through the connector's answer.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_nonce = {}
+
+    def wrap(self, connector):
+        get_address_nonce = getattr(connector, 'get_address_nonce', None)
+        if get_address_nonce is None:
+            logger.info('Connector has no get_address_nonce, nonces are managed by cert_issuer')
+            return
+
+        def managed_nonce(address, *args, **kwargs):
+            with self.lock:
+                nonce = max(get_address_nonce(address, *args, **kwargs), self.next_nonce.get(address, 0))
+                self.next_nonce[address] = nonce + 1
+                return nonce
+
+        connector.get_address_nonce = managed_nonce
+
+    def reset(self):
+        # After a failed transaction the local counter may be ahead of the chain
+        with self.lock:
+            self.next_nonce.clear()
@@ -1,28 +1,103 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+import ipfshttpclient
+import cert_issuer.issue_certificates
+from controller.metrics import stage, in_flight
+
+local_clients = threading.local()
+clients = []
+clients_lock = threading.Lock()
+upload_executor = None
+
+
+def get_ipfs_client():
+    """
+    Returns this thread's IPFS client. The client keeps its HTTP session open, so uploads reuse the connection to the
+    IPFS container instead of connecting for every file. Sessions are not shared between threads.
+    """
+    client = getattr(local_clients, 'client', None)
+    if client is None:
+        # Important to put name of IPFS container
+        client = ipfshttpclient.connect(os.getenv("IPFS_API_ADDRESS", '/dns/ipfs/tcp/5001'), session=True)
+        local_clients.client = client
+        with clients_lock:
+            clients.append(client)
+    return client
+
+
+def get_upload_executor():
+    global upload_executor
+    if upload_executor is None:
+        upload_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=int(os.getenv("IPFS_MAX_CONCURRENT_ADDS", "8")), thread_name_prefix='ipfs-upload')
+    return upload_executor
+
+
+def shutdown_ipfs_uploads():
+    global upload_executor
+    if upload_executor is not None:
+        upload_executor.shutdown(wait=True)
+        upload_executor = None
+    with clients_lock:
+        for client in clients:
+            try:
+                client.close()
+            except Exception:
+                pass
+        clients.clear()
+
+
 def add_file_ipfs(cert_path):
-    ipfs_batch_file = "./data/meta_certificates/" + str(uuid.uuid1()) + '.json'
-    ipfs_object = {"file_certifications": []}
-    # Important to put name of IPFS container
-    client = ipfshttpclient.connect('/dns/ipfs/tcp/5001')
-    hash = client.add(cert_path)
+    with stage('ipfs_add'), in_flight('ipfs_add'):
+        hash = get_ipfs_client().add(cert_path)
     return hash['Hash']
 
+def add_json_ipfs(json_object):
+    with stage('ipfs_add'), in_flight('ipfs_add'):
+        return get_ipfs_client().add_json(json_object)
+
+async def add_certificates_ipfs(certificates):
+    """
+    Adds the certificates to IPFS concurrently, at most IPFS_MAX_CONCURRENT_ADDS at a time per worker, and returns
+    their hashes in the same order.
+    """
+    loop = asyncio.get_event_loop()
+    executor = get_upload_executor()
+    return await asyncio.gather(*[loop.run_in_executor(executor, add_json_ipfs, certificate)
+                                  for certificate in certificates])
+
+def build_manifest(fileIDs, certificates, ipfsHashes):
+    """ Batch manifest listing the IPFS location of every certificate, published once per batch. """
+    return {"file_certifications": [
+        {"id": fileID, "ipfsHash": 'http://ipfs.io/ipfs/' + ipfsHash, "crid": certificate["crid"]}
+        for fileID, certificate, ipfsHash in zip(fileIDs, certificates, ipfsHashes)]}
+
 def update_ipfs_link(token_id, token_uri):
+    from controller.cert_issuer.sign_certificate import get_config, get_handler_pool
     config = get_config()
     print(config.unsigned_certificates_dir)
-    certificate_batch_handler, transaction_handler, connector = \
-        ethereum_sc.instantiate_blockchain_handlers(config)
+    handler_pool = get_handler_pool()
+    pooled = handler_pool.acquire()
+    certificate_batch_handler, transaction_handler, connector = pooled.handlers
     # calling the smart contract to update the token uri for the token id
-    cert_issuer.issue_certificates.update_token_uri(config, certificate_batch_handler, transaction_handler, token_id,
-                                           token_uri)
+    try:
+        cert_issuer.issue_certificates.update_token_uri(config, certificate_batch_handler, transaction_handler, token_id,
+                                               token_uri)
+    except Exception:
+        handler_pool.release(pooled, healthy=False)
+        raise
+    handler_pool.release(pooled)
     return
 
-##Experimental IPNS - IPNS is still in Alpha so it is relatively slow. Not recommended for production
-# TODO: Implement key rotation
-def add_file_ipns(ipfsHash, generateKey, newKey=None):
-    client = ipfshttpclient.connect('/dns/ipfs/tcp/5001')
-    if generateKey is True:
-        newKey = str(uuid.uuid1())
-        client.key.gen(newKey, "rsa")["Name"]
-    tempAddress = '/ipfs/' + ipfsHash
-    ipnshash = client.name.publish(tempAddress, key=newKey, timeout=300)
-    return ipnshash, newKey
\ No newline at end of file
+##Experimental IPNS - IPNS is still in Alpha so it is relatively slow, names are published by the IPNSPublisher
+def generate_ipns_key(key_name):
+    """ Generates a key on the IPFS node and returns its IPNS name. """
+    key = get_ipfs_client().key.gen(key_name, os.getenv("IPNS_KEY_TYPE", "rsa"))
+    return key["Id"]
+
+def publish_ipns_name(key_name, ipfs_path):
+    timeout = float(os.getenv("IPNS_PUBLISH_TIMEOUT_SECONDS", "300"))
+    with stage('ipns_publish'):
+        return get_ipfs_client().name.publish(ipfs_path, key=key_name, timeout=timeout)
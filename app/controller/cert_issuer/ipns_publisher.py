@@ -0,0 +1,246 @@
+import asyncio
+import logging
+import os
+import random
+import time
+import uuid
+from controller.sqlite_transaction import connect
+
+logger = logging.getLogger(__name__)
+
+AVAILABLE = "available"
+RESERVED = "reserved"
+PENDING = "pending"
+PUBLISHED = "published"
+FAILED = "failed"
+
+
+class IPNSStore:
+    """
+    IPNS keys and publication status in the local SQLite database, shared by all gunicorn workers of cert_issuer_api,
+    so a pooled key is only handed to one batch and the status can be asked from any worker.
+    """
+
+    def __init__(self, db_location):
+        self.db_location = db_location
+        with connect(self.db_location) as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS ipns_names (
+                    ipns_name TEXT PRIMARY KEY,
+                    key_name TEXT,
+                    status TEXT,
+                    ipfs_path TEXT,
+                    attempts INTEGER DEFAULT 0,
+                    error TEXT,
+                    created REAL,
+                    updated REAL)""")
+            connection.execute("CREATE INDEX IF NOT EXISTS ipns_names_status ON ipns_names (status, created)")
+
+    def add_key(self, key_name, ipns_name, status=AVAILABLE):
+        now = time.time()
+        with connect(self.db_location) as connection:
+            connection.execute(
+                "INSERT INTO ipns_names (ipns_name, key_name, status, created, updated) VALUES (?, ?, ?, ?, ?)",
+                (ipns_name, key_name, status, now, now))
+
+    def available_keys(self):
+        with connect(self.db_location) as connection:
+            return connection.execute("SELECT COUNT(*) FROM ipns_names WHERE status = ?", (AVAILABLE,)).fetchone()[0]
+
+    def claim_key(self):
+        """ Atomically reserves the oldest pooled key and returns (key_name, ipns_name), or None if the pool is empty. """
+        with connect(self.db_location) as connection:
+            row = connection.execute(
+                "SELECT ipns_name, key_name FROM ipns_names WHERE status = ? ORDER BY created LIMIT 1",
+                (AVAILABLE,)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE ipns_names SET status = ?, updated = ? WHERE ipns_name = ?",
+                               (RESERVED, time.time(), row["ipns_name"]))
+        return row["key_name"], row["ipns_name"]
+
+    def update(self, ipns_name, status, ipfs_path=None, attempts=None, error=None):
+        with connect(self.db_location) as connection:
+            connection.execute(
+                "UPDATE ipns_names SET status = ?, ipfs_path = COALESCE(?, ipfs_path), "
+                "attempts = COALESCE(?, attempts), error = ?, updated = ? WHERE ipns_name = ?",
+                (status, ipfs_path, attempts, error, time.time(), ipns_name))
+
+    def abandon(self, ipns_name, error):
+        """ Marks a reserved name as failed, names that are already pending or published are left alone. """
+        with connect(self.db_location) as connection:
+            connection.execute("UPDATE ipns_names SET status = ?, error = ?, updated = ? WHERE ipns_name = ? "
+                               "AND status = ?", (FAILED, error, time.time(), ipns_name, RESERVED))
+
+    def claim_stale(self, status, older_than):
+        """
+        Returns (ipns_name, ipfs_path) of the names in status that were not updated since older_than and touches
+        them, so the other workers don't pick them up as well.
+        """
+        with connect(self.db_location) as connection:
+            rows = connection.execute("SELECT ipns_name, ipfs_path FROM ipns_names WHERE status = ? AND updated < ?",
+                                      (status, older_than)).fetchall()
+            connection.execute("UPDATE ipns_names SET updated = ? WHERE status = ? AND updated < ?",
+                               (time.time(), status, older_than))
+        return [(row["ipns_name"], row["ipfs_path"]) for row in rows]
+
+    def key_name(self, ipns_name):
+        with connect(self.db_location) as connection:
+            return connection.execute("SELECT key_name FROM ipns_names WHERE ipns_name = ?",
+                                      (ipns_name,)).fetchone()["key_name"]
+
+    def get(self, ipns_name):
+        with connect(self.db_location) as connection:
+            row = connection.execute("SELECT * FROM ipns_names WHERE ipns_name = ?", (ipns_name,)).fetchone()
+        if row is None or row["status"] == AVAILABLE:
+            return None
+        status = {"ipnsName": row["ipns_name"], "status": row["status"], "attempts": row["attempts"],
+                  "updated": row["updated"]}
+        if row["ipfs_path"] is not None:
+            status["ipfsPath"] = row["ipfs_path"]
+        if row["error"] is not None:
+            status["error"] = row["error"]
+        return status
+
+
+class IPNSPublisher:
+    """
+    Hands out IPNS names from a pool of pre-generated keys and publishes them in the background. The IPNS name of a
+    key is known as soon as the key exists, so it can be used as tokenURI before anything is published, and the slow
+    `name.publish` no longer runs on the request path.
+
+    `generate_key(key_name)` returns the IPNS name of a newly generated key and `publish_name(key_name, ipfs_path)`
+    publishes the path under that key. Both are blocking and run in the default executor.
+
+    Pending publishes are queued in the worker that issued the batch. If that worker goes away, the names are not
+    updated anymore and any worker requeues them after stale_seconds. Names that stay reserved for longer than
+    reserved_timeout belong to an issuance that never finished and are marked failed.
+    """
+
+    def __init__(self, store, generate_key, publish_name, pool_size=4, concurrency=2, retries=3,
+                 retry_backoff=5.0, stale_seconds=900.0, reserved_timeout=3600.0):
+        self.store = store
+        self.generate_key = generate_key
+        self.publish_name = publish_name
+        self.pool_size = pool_size
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        # Longer than one publish attempt, every attempt updates the name
+        self.stale_seconds = stale_seconds
+        self.reserved_timeout = reserved_timeout
+        self.queue = asyncio.Queue()
+        self.refill_needed = asyncio.Event()
+        self.tasks = []
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        self.tasks = [loop.create_task(self._refill()), loop.create_task(self._recover())]
+        self.tasks += [loop.create_task(self._publish_queued()) for _ in range(self.concurrency)]
+        self.refill_needed.set()
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def reserve_name(self):
+        """ Returns the IPNS name of a key that is reserved for one batch. """
+        loop = asyncio.get_event_loop()
+        claimed = await loop.run_in_executor(None, self.store.claim_key)
+        self.refill_needed.set()
+        if claimed is not None:
+            return claimed[1]
+        # Pool is exhausted, generate the key for this batch directly
+        logger.info('IPNS key pool is empty, generating a key on the request path')
+        key_name = new_key_name()
+        ipns_name = await loop.run_in_executor(None, self.generate_key, key_name)
+        await loop.run_in_executor(None, self.store.add_key, key_name, ipns_name, RESERVED)
+        return ipns_name
+
+    async def publish(self, ipns_name, ipfs_hash):
+        """ Queues publishing /ipfs/<ipfs_hash> under the reserved IPNS name, see status() for the progress. """
+        ipfs_path = '/ipfs/' + ipfs_hash
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.store.update, ipns_name, PENDING, ipfs_path, 0)
+        self.queue.put_nowait((ipns_name, ipfs_path))
+
+    async def abandon(self, ipns_name, error):
+        """ Marks a reserved name as failed when its batch was not issued, so it is neither published nor reused. """
+        await asyncio.get_event_loop().run_in_executor(None, self.store.abandon, ipns_name, error)
+
+    async def status(self, ipns_name):
+        return await asyncio.get_event_loop().run_in_executor(None, self.store.get, ipns_name)
+
+    async def _refill(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self.refill_needed.wait()
+            self.refill_needed.clear()
+            try:
+                while await loop.run_in_executor(None, self.store.available_keys) < self.pool_size:
+                    key_name = new_key_name()
+                    ipns_name = await loop.run_in_executor(None, self.generate_key, key_name)
+                    await loop.run_in_executor(None, self.store.add_key, key_name, ipns_name)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning('Refilling the IPNS key pool failed: %s', e)
+                await asyncio.sleep(self.retry_backoff)
+                self.refill_needed.set()
+
+    async def _recover(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                now = time.time()
+                for ipns_name, ipfs_path in await loop.run_in_executor(None, self.store.claim_stale, PENDING,
+                                                                       now - self.stale_seconds):
+                    logger.info('Requeueing the publish of IPNS name %s', ipns_name)
+                    self.queue.put_nowait((ipns_name, ipfs_path))
+                for ipns_name, _ in await loop.run_in_executor(None, self.store.claim_stale, RESERVED,
+                                                               now - self.reserved_timeout):
+                    await self.abandon(ipns_name, 'The issuance of the batch never finished')
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning('Recovering IPNS names failed: %s', e)
+            await asyncio.sleep(min(self.stale_seconds, self.reserved_timeout) / 2)
+
+    async def _publish_queued(self):
+        while True:
+            ipns_name, ipfs_path = await self.queue.get()
+            await self.publish_with_retries(ipns_name, ipfs_path)
+
+    async def publish_with_retries(self, ipns_name, ipfs_path):
+        loop = asyncio.get_event_loop()
+        key_name = await loop.run_in_executor(None, self.store.key_name, ipns_name)
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                await loop.run_in_executor(None, self.publish_name, key_name, ipfs_path)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = str(e) or type(e).__name__
+                if attempt > self.retries:
+                    logger.warning('Publishing IPNS name %s failed: %s', ipns_name, error)
+                    await loop.run_in_executor(None, self.store.update, ipns_name, FAILED, None, attempt, error)
+                    return
+                await loop.run_in_executor(None, self.store.update, ipns_name, PENDING, None, attempt, error)
+                await asyncio.sleep(self.retry_backoff * 2 ** (attempt - 1) * (1 + random.random()))
+                continue
+            await loop.run_in_executor(None, self.store.update, ipns_name, PUBLISHED, None, attempt)
+            logger.info('Published %s under IPNS name %s', ipfs_path, ipns_name)
+            return
+
+
+def new_key_name():
+    return 'bloxberg-' + str(uuid.uuid4())
+
+
+def get_ipns_db_location():
+    # The SQLite volume of certify-api.yml, a relative path would end up in the cert-issuer checkout (working_dir)
+    return os.getenv("IPNS_DB_LOCATION", "/app/sqlite.db")
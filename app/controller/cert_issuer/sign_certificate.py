@@ -2,9 +2,13 @@ from typing import List, Optional
 from functools import lru_cache
 from fastapi import Depends, FastAPI, Request, HTTPException, status
 from pydantic import BaseModel
+import asyncio
+import concurrent.futures
 import json
 import os
-import cProfile
+import copy
+import shutil
+import tempfile
 import ipfshttpclient
 import uuid
 from fastapi.middleware.cors import CORSMiddleware
@@ -13,15 +17,36 @@ import cert_issuer.config
 from cert_issuer.blockchain_handlers import ethereum_sc
 import cert_issuer.issue_certificates
 from fastapi import APIRouter
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from controller.anchor_store import AnchorStore, get_anchor_db_location
+from controller.batch_workspace import BatchWorkspace, is_valid_batch_id
+from controller.metrics import stage, in_flight, observe_batch_size
+from controller.cert_issuer.batch_coalescer import BatchCoalescer
+from controller.cert_issuer.blockchain_handlers import BlockchainHandlerPool, NonceManager
+from controller.cert_issuer.ipfs_handlers import add_json_ipfs, add_certificates_ipfs, build_manifest, \
+    generate_ipns_key, publish_ipns_name
+from controller.cert_issuer.ipns_publisher import IPNSPublisher, IPNSStore, get_ipns_db_location
+from controller.cert_tools.merkle_proof import decode_proof_value, get_anchor
 
 router = APIRouter()
 config = None
+batch_coalescer = None
+handler_pool = None
+issuance_executor = None
+ipns_publisher = None
+anchor_store = None
 
 
 class createToken(BaseModel):
     recipientPublickey: str
     unSignedCerts: List[str]
     enableIPFS: bool
+    # In-memory pipeline: unsigned certificates in the same order as unSignedCerts, instead of files in the shared
+    # unsigned_certificates directory. The signed certificates are returned without being kept on disk.
+    unSignedCertificates: Optional[List[dict]]
+    # File pipeline: the unsigned certificates are read from <unsigned_certificates_dir>/<batchId>
+    batchId: Optional[str]
 
     # Used only for Testing API, not for entire workflow.
     class Config:
@@ -41,83 +66,252 @@ def get_config():
     return config
 
 
-async def issue_batch_to_blockchain(config, certificate_batch_handler, transaction_handler, recipientPublicKey,
-                                    tokenURI):
-    (tx_id, token_id) = cert_issuer.issue_certificates.issue(config, certificate_batch_handler, transaction_handler,
-                                                             recipientPublicKey, tokenURI)
-    return tx_id, token_id
+async def issue_batch_to_blockchain(config, recipientPublicKey, tokenURI):
+    """
+    Runs the blocking issuance (sign, broadcast, wait for the receipt) in the issuance executor, so the event loop of
+    this worker stays free and up to ISSUER_MAX_INFLIGHT_TX transactions are pending at the same time.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(get_issuance_executor(), issue_with_pooled_handlers, config,
+                                      recipientPublicKey, tokenURI)
+
+
+def issue_with_pooled_handlers(config, recipientPublicKey, tokenURI):
+    handler_pool = get_handler_pool()
+    pooled = handler_pool.acquire()
+    certificate_batch_handler, transaction_handler, connector = pooled.handlers
+    try:
+        # Signing, sending and waiting for the receipt all happen inside cert_issuer, so they are one stage
+        with stage('transaction'), in_flight('transaction'):
+            (tx_id, token_id) = cert_issuer.issue_certificates.issue(config, certificate_batch_handler,
+                                                                     transaction_handler, recipientPublicKey, tokenURI)
+        issuedCerts = list(certificate_batch_handler.certificates_to_issue)
+    except Exception:
+        handler_pool.release(pooled, healthy=False)
+        raise
+    handler_pool.release(pooled)
+    return tx_id, token_id, issuedCerts
+
+
+def get_issuance_executor():
+    global issuance_executor
+    if issuance_executor is None:
+        issuance_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=int(os.getenv("ISSUER_MAX_INFLIGHT_TX", "4")), thread_name_prefix='issuance')
+    return issuance_executor
+
+
+def shutdown_issuance_executor():
+    global issuance_executor
+    if issuance_executor is not None:
+        issuance_executor.shutdown(wait=False)
+        issuance_executor = None
+
+
+async def issue_coalesced_batch(key, certificates):
+    """
+    Issues the merged certificates of one coalesced batch and returns (tx_id, token_id, signedCerts) where signedCerts
+    maps each certificate id to its signed certificate. Each item of certificates is (id, certificate) in the in-memory
+    pipeline and (id, path of the unsigned certificate) in the file pipeline.
+    """
+    recipientPublicKey, tokenURI, inMemory = key
+    observe_batch_size('issued_batch', len(certificates))
+    # The batch is issued from a private workspace, so nothing outside of it is read, written or removed
+    workspace = await run_in_threadpool(BatchWorkspace, get_workspace_root())
+    try:
+        with stage('certificate_staging'):
+            config = await run_in_threadpool(stage_certificates, workspace, certificates, inMemory)
+        tx_id, token_id, issuedCerts = await issue_batch_to_blockchain(config, recipientPublicKey, tokenURI)
+        with stage('certificate_readback'):
+            signedCerts = await run_in_threadpool(read_signed_certificates, config, issuedCerts)
+    finally:
+        await run_in_threadpool(workspace.cleanup)
+    await run_in_threadpool(record_anchor, tx_id, signedCerts)
+    return tx_id, token_id, signedCerts
+
+
+def record_anchor(tx_id, signedCerts):
+    """ Remembers the Merkle root of the transaction, so cert_tools_api verifies its certificates offline. """
+    try:
+        decodedProof = decode_proof_value(next(iter(signedCerts.values()))['proof']['proofValue'])
+        get_anchor_store().add(tx_id, decodedProof['merkleRoot'], get_anchor(decodedProof)[0])
+    except Exception as e:
+        print(e)
+
+
+def get_anchor_store():
+    global anchor_store
+    if anchor_store is None:
+        anchor_store = AnchorStore(get_anchor_db_location())
+    return anchor_store
+
+
+def stage_certificates(workspace, certificates, inMemory):
+    config = scoped_config(get_config(), workspace)
+    for fileID, certificate in certificates:
+        unsigned_path = os.path.join(config.unsigned_certificates_dir, fileID + '.json')
+        if inMemory:
+            with open(unsigned_path, 'w') as f:
+                json.dump(certificate, f)
+        else:
+            link_or_copy(certificate, unsigned_path)
+    return config
+
+
+def read_signed_certificates(config, issuedCerts):
+    signedCerts = {}
+    for fileID in issuedCerts:
+        with open(os.path.join(config.blockchain_certificates_dir, fileID + '.json')) as f:
+            signedCerts[fileID] = json.load(f)
+    return signedCerts
+
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def get_workspace_root():
+    return os.getenv("ISSUER_WORKSPACE_DIR", os.path.join(tempfile.gettempdir(), "cert_issuer_workspaces"))
+
+
+def scoped_config(config, workspace):
+    """ Copy of the issuer config whose certificate directories all live inside the given batch workspace. """
+    scoped = copy.copy(config)
+    scoped.unsigned_certificates_dir = workspace.subdir('unsigned_certificates')
+    scoped.signed_certificates_dir = workspace.subdir('signed_certificates')
+    scoped.blockchain_certificates_dir = workspace.subdir('blockchain_certificates')
+    scoped.work_dir = workspace.subdir('work')
+    return scoped
+
+
+def get_handler_pool():
+    """ Blockchain handlers of this worker, built from the global config and reused across batches. """
+    global handler_pool
+    if handler_pool is None:
+        handler_pool = BlockchainHandlerPool(lambda: ethereum_sc.instantiate_blockchain_handlers(get_config()),
+                                             size=int(os.getenv("ISSUER_MAX_INFLIGHT_TX", "4")),
+                                             health_check_seconds=float(os.getenv("HANDLER_HEALTH_CHECK_SECONDS", "60")),
+                                             nonce_manager=NonceManager())
+    return handler_pool
+
+
+def get_ipns_publisher():
+    """ Started on first use, so workers that never see an IPFS batch don't generate IPNS keys. """
+    global ipns_publisher
+    if ipns_publisher is None:
+        ipns_publisher = IPNSPublisher(IPNSStore(get_ipns_db_location()), generate_ipns_key, publish_ipns_name,
+                                       pool_size=int(os.getenv("IPNS_KEY_POOL_SIZE", "4")),
+                                       concurrency=int(os.getenv("IPNS_PUBLISH_CONCURRENCY", "2")),
+                                       retries=int(os.getenv("IPNS_PUBLISH_RETRIES", "3")),
+                                       retry_backoff=float(os.getenv("IPNS_PUBLISH_BACKOFF_SECONDS", "5")),
+                                       stale_seconds=float(os.getenv("IPNS_PENDING_STALE_SECONDS", "900")),
+                                       reserved_timeout=float(os.getenv("IPNS_RESERVED_TIMEOUT_SECONDS", "3600")))
+        ipns_publisher.start()
+    return ipns_publisher
+
+
+async def stop_ipns_publisher():
+    global ipns_publisher
+    if ipns_publisher is not None:
+        await ipns_publisher.stop()
+        ipns_publisher = None
+
+
+def get_batch_coalescer():
+    global batch_coalescer
+    if batch_coalescer is None:
+        window_seconds = float(os.getenv("COALESCE_WINDOW_MS", "0")) / 1000
+        max_batch_size = int(os.getenv("COALESCE_MAX_CERTIFICATES", "1000"))
+        batch_coalescer = BatchCoalescer(issue_coalesced_batch, window_seconds, max_batch_size)
+    return batch_coalescer
 
 
 # Full Workflow - Called from cert_tools_api
 @router.post("/issueBloxbergCertificate")
-async def issue(createToken: createToken, request: Request):
+async def issue(createToken: createToken, request: Request, stream: bool = False):
     config = get_config()
-    certificate_batch_handler, transaction_handler, connector = \
-        ethereum_sc.instantiate_blockchain_handlers(config)
+    inMemory = createToken.unSignedCertificates is not None
+    if inMemory and len(createToken.unSignedCertificates) != len(createToken.unSignedCerts):
+        raise HTTPException(status_code=400, detail="unSignedCertificates must match unSignedCerts")
+    # The ids become file names in the batch directories and the workspace, only UUIDs keep them inside of them
+    if not all(is_valid_batch_id(fileID) for fileID in createToken.unSignedCerts):
+        raise HTTPException(status_code=400, detail="unSignedCerts must be UUIDs")
+    if createToken.batchId is not None and not is_valid_batch_id(createToken.batchId):
+        raise HTTPException(status_code=400, detail="Invalid batchId")
 
-        # file that stores the ipfs hashes of the certificates in the batch
     if createToken.enableIPFS is True:
         try:
-            ipfsHash = add_file_ipfs("./data/meta_certificates/.placeholder")
-            generateKey = True
-            ipnsHash, generatedKey = add_file_ipns(ipfsHash, generateKey)
-            tokenURI = 'http://ipfs.io/ipns/' + ipnsHash['Name']
+            # The IPNS name is fixed by the pooled key, the batch manifest is published under it after issuing
+            ipnsName = await get_ipns_publisher().reserve_name()
+            tokenURI = 'http://ipfs.io/ipns/' + ipnsName
         except Exception as e:
             print(e)
             raise HTTPException(status_code=400, detail=f"Couldn't add file to IPFS")
     else:
         tokenURI = 'https://bloxberg.org'
     try:
-        #pr = cProfile.Profile()
-        #pr.enable()
-        tx_id, token_id = await issue_batch_to_blockchain(config, certificate_batch_handler, transaction_handler,
-                                          createToken.recipientPublickey, tokenURI)
-        #pr.disable()
-        #pr.print_stats(sort="tottime")
-        #pr.dump_stats('profileAPI.pstat')
+        if inMemory:
+            certificates = list(zip(createToken.unSignedCerts, createToken.unSignedCertificates))
+        else:
+            unsigned_dir = os.path.join(config.unsigned_certificates_dir, createToken.batchId or '')
+            certificates = [(fileID, os.path.join(unsigned_dir, fileID + '.json')) for fileID in createToken.unSignedCerts]
+        # Requests for the same recipient and token URI may share one transaction, see COALESCE_WINDOW_MS
+        tx_id, token_id, signedCerts = await get_batch_coalescer().submit(
+            (createToken.recipientPublickey, tokenURI, inMemory), certificates)
     except Exception as e:
         print(e)
+        if createToken.enableIPFS is True:
+            await abandon_ipns_name(ipnsName, 'The batch was not issued')
         raise HTTPException(status_code=400, detail=f"Failed to issue certificate batch to the blockchain")
 
-    # Retrieve file path of certified transaction
-    blockchain_file_path = config.blockchain_certificates_dir
     json_data = []
+    fileIDs = []
 
-    for fileID in certificate_batch_handler.certificates_to_issue:
-        full_path_with_file = str(blockchain_file_path + '/' + fileID + '.json')
-        if createToken.enableIPFS is True:
-            ipfsHash = add_file_ipfs(full_path_with_file)
-
-        with open(full_path_with_file) as f:
-            d = json.load(f)
-        # Save JSON Certificate to IPFS
-        if createToken.enableIPFS is True:
-            temp = ipfs_object["file_certifications"]
-            y = {"id": fileID, "ipfsHash": 'http://ipfs.io/ipfs/' + ipfsHash, "crid": d["crid"]}
-            temp.append(y)
+    # Only return the certificates of this request, a coalesced batch also contains those of other requests
+    for fileID in createToken.unSignedCerts:
+        if fileID not in signedCerts:
+            continue
+        fileIDs.append(fileID)
+        json_data.append(signedCerts[fileID])
 
-        json_data.append(d)
-
-    # write ipfs object into the ipfs batch file
+    # Save the JSON certificates to IPFS and publish one manifest of the batch under the IPNS name
     try:
         if createToken.enableIPFS is True:
-            with open(ipfs_batch_file, 'w') as file:
-                json.dump(ipfs_object, file)
-            ipfs_batch_hash = add_file_ipfs(ipfs_batch_file)
-            generateKey = False
-            ipnsHash = add_file_ipns(ipfs_batch_hash, generateKey, newKey=generatedKey)
-            print("Updated IPNS Hash")
-            print(ipnsHash)
+            ipfsHashes = await add_certificates_ipfs(json_data)
+            ipfs_batch_hash = await run_in_threadpool(add_json_ipfs, build_manifest(fileIDs, json_data, ipfsHashes))
+            await get_ipns_publisher().publish(ipnsName, ipfs_batch_hash)
             # update_ipfs_link(token_id, 'http://ipfs.io/ipfs/' + ipfs_batch_hash)
     except:
+        await abandon_ipns_name(ipnsName, 'Adding the batch to IPFS failed')
         return "Updating IPNS link failed,"
 
-    python_environment = os.getenv("app")
-    if python_environment == "production":
-        full_path_with_file = str(config.blockchain_certificates_dir + '/')
-        for file_name in os.listdir(full_path_with_file):
-            if file_name.endswith('.json'):
-                print(full_path_with_file + file_name)
-                os.remove(full_path_with_file + file_name)
+    if stream:
+        return StreamingResponse(ndjson_lines(json_data), media_type="application/x-ndjson")
+    return json_data
+
+
+async def abandon_ipns_name(ipnsName, error):
+    # Otherwise the name stays reserved until IPNS_RESERVED_TIMEOUT_SECONDS
+    try:
+        await get_ipns_publisher().abandon(ipnsName, error)
+    except Exception as e:
+        print(e)
+
+
+def ndjson_lines(certificates):
+    for certificate in certificates:
+        yield (json.dumps(certificate) + '\n').encode('utf-8')
+
 
-    return json_data
\ No newline at end of file
+@router.get("/ipnsStatus/{ipnsName}")
+async def ipnsStatus(ipnsName: str):
+    """
+    Publishing state of the IPNS name used as tokenURI of an IPFS batch: pending, published or failed.
+    """
+    status = await get_ipns_publisher().status(ipnsName)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown IPNS name")
+    return status
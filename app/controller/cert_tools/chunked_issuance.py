@@ -0,0 +1,55 @@
+import asyncio
+import os
+
+
+def split_chunks(items, chunk_size):
+    return [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+
+
+async def issue_chunks(chunks, issue_chunk, concurrency):
+    """
+    Issues the chunks with `issue_chunk(chunk)`, keeping up to `concurrency` of them in flight so their transactions
+    are pending together, and yields (index, chunk, result, error) in chunk order. A failed chunk does not stop the
+    following ones, its error is yielded instead of the result.
+    """
+    loop = asyncio.get_event_loop()
+    tasks = {}
+    try:
+        for index, chunk in enumerate(chunks):
+            for ahead in range(index, min(index + concurrency, len(chunks))):
+                if ahead not in tasks:
+                    tasks[ahead] = loop.create_task(issue_chunk(chunks[ahead]))
+            task = tasks.pop(index)
+            try:
+                result, error = await task, None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                result, error = None, e
+            yield index, chunk, result, error
+    finally:
+        for task in tasks.values():
+            if task.done():
+                if not task.cancelled():
+                    task.exception()
+            else:
+                task.cancel()
+
+
+def get_chunk_size():
+    # Certificates per Merkle batch and transaction, cert_issuer_api coalesces up to COALESCE_MAX_CERTIFICATES
+    return int(os.getenv("CERTIFY_CHUNK_SIZE", "1000"))
+
+
+def get_chunk_concurrency():
+    return int(os.getenv("CERTIFY_CHUNK_CONCURRENCY", "4"))
+
+
+def get_max_crids():
+    # Buffered responses and job results hold every certificate in memory, about 5 KB each
+    return int(os.getenv("CERTIFY_MAX_CRIDS", "1000"))
+
+
+def get_max_stream_crids():
+    # Streamed responses only hold the chunks in flight, so they may be much larger
+    return int(os.getenv("CERTIFY_MAX_STREAM_CRIDS", "100000"))
@@ -1,19 +1,29 @@
-from lds_merkle_proof_2019.merkle_proof_2019 import MerkleProof2019
-from zipfile import ZipFile
-import pyqrcode
+from zipfile import ZipFile, is_zipfile
 from typing import List, Optional
-import fitz
+import collections
 import json
 import uuid
 import io
 import os
 from fastapi_simple_security import api_key_security
 from pydantic import BaseModel, Field, Json
-from fastapi.responses import FileResponse
-from fastapi import Depends, APIRouter, BackgroundTasks, HTTPException
+from fastapi.responses import FileResponse, StreamingResponse
+from fastapi import Depends, APIRouter, BackgroundTasks, HTTPException, Request
+from controller.batch_workspace import BatchWorkspace
+from controller.metrics import stage, in_flight, observe_batch_size
+from controller.cert_tools.merkle_proof import decode_proof_value, decode_proof_values
+from controller.cert_tools.pdf_renderer import buildPDF, buildPDFBytes, render_ordered, tryExtractCertificate, \
+    rejectPDF
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 router = APIRouter()
 
+PDF_WORKSPACE_ROOT = "./sample_data/pdf_certificates"
+
 
 class jsonCertificate(BaseModel):
     context: Optional[List[str]] = Field(
@@ -74,12 +84,14 @@ class jsonCertificateBatch(BaseModel):
 # the files from given directory that matches the filter
 def zipfilesindir(dirName, zipFileName, filter=None):
     # create a ZipFile object
+    if filter is not None:
+        filter = set(filter)
     with ZipFile(zipFileName, 'w') as zipObj:
         # Iterate over all the files in directory
         for folderName, subfolders, filenames in os.walk(dirName):
             for filename in filenames:
                 removedExtension = os.path.splitext(filename)[0]
-                if removedExtension in filter or filter is None:
+                if filter is None or removedExtension in filter:
                     # create complete filepath of file in directory
                     filePath = os.path.join(folderName, filename)
                     # Add file to zip
@@ -87,116 +99,201 @@ def zipfilesindir(dirName, zipFileName, filter=None):
         return
 
 
+class ZipStreamBuffer(io.RawIOBase):
+    """
+    Write-only, unseekable target for ZipFile. Everything written since the last drain() is handed to the response, so
+    the archive never exists as a whole in memory or on disk.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.offset += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.offset
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def serializeCertificate(certificate):
+    """
+    Returns (content, certificateJson), the UTF-8 JSON bytes to embed and the dict used for the printed fields. The
+    validated model is dumped once with its aliases ('@context') and encoded directly, with orjson when installed.
+    """
+    certificateJson = certificate.dict(by_alias=True)
+    if orjson is not None:
+        content = orjson.dumps(certificateJson)
+    else:
+        content = json.dumps(certificateJson).encode('utf8')
+    return content, certificateJson
+
+
+async def streamPDFZip(request, decodedProofs):
+    buffer = ZipStreamBuffer()
+    # PDFs are rendered in the process pool and added to the archive in request order as soon as they are ready
+    tasks = ((buildPDFBytes, serializeCertificate(certificate) + (decodedProof,))
+             for certificate, decodedProof in zip(request, decodedProofs))
+    with ZipFile(buffer, 'w') as zipObj:
+        async for pdfBytes in render_ordered(tasks):
+            with stage('zip'):
+                zipObj.writestr(str(uuid.uuid1()) + '.pdf', pdfBytes)
+            yield buffer.drain()
+    # central directory
+    yield buffer.drain()
+
+
 @router.post("/generatePDF", tags=['pdf'], dependencies=[Depends(api_key_security)])
-async def generatePDF(request: List[jsonCertificate], background_tasks: BackgroundTasks):
+async def generatePDF(request: List[jsonCertificate], background_tasks: BackgroundTasks, stream: bool = False):
     """
     Accepts as input the response from the createBloxbergCertificate endpoint, for example a research object JSON array. Returns as response a zip archive with PDF files that correspond to the number of cryptographic identifiers provided. PDF files are embedded with the Research Object Certification which is used for verification.
+
+    With stream=true the zip archive is streamed while the PDFs are generated, without temporary files.
     """
+    observe_batch_size('pdf_request', len(request))
+    if stream:
+        # Proofs are checked before the first byte is sent, afterwards errors can no longer become a 400 response.
+        decodedProofs = decode_proofs(request)
+        resp = StreamingResponse(streamPDFZip(request, decodedProofs), media_type="application/x-zip-compressed")
+        resp.headers['Content-Disposition'] = 'attachment; filename=bloxbergResearchCertificates'
+        return resp
+
+    # PDFs and the zip of this request live in their own workspace, removed after the response or on failure.
+    workspace = BatchWorkspace(PDF_WORKSPACE_ROOT)
     try:
         # For JSON Certificate Batch Request
         # requestJson = request.json()
         # certificateObject = json.loads(request)
-        uidArray = []
-        for certificate in request:
-            requestJson = certificate.json()
-            certificateJson = json.loads(requestJson)
-            certificateJson['@context'] = certificateJson.pop('context')
-            generatedID = str(uuid.uuid1())
-            uidArray.append(generatedID)
-            stringCert = json.dumps(certificateJson)
-            bytestring = io.StringIO(stringCert)
-            content = io.BytesIO(bytestring.read().encode('utf8'))
-            await buildPDF(content, certificateJson, generatedID)
+        uidArray = [str(uuid.uuid1()) for certificate in request]
+        decodedProofs = decode_proofs(request)
+        tasks = ((buildPDF, serializeCertificate(certificate) + (decodedProof, workspace.file(generatedID + '.pdf')))
+                 for certificate, decodedProof, generatedID in zip(request, decodedProofs, uidArray))
+        with in_flight('pdf_request'):
+            async for pdfPath in render_ordered(tasks):
+                pass
     except Exception as e:
         print(e)
+        workspace.cleanup()
         raise HTTPException(status_code=400, detail="Failed building PDF")
 
     try:
-        tempZip = str(uuid.uuid1())
-        filePathZip = "./sample_data/zipFiles/" + tempZip + ".zip"
-        zipfilesindir("./sample_data/pdf_certificates", filePathZip, uidArray)
+        filePathZip = workspace.file(workspace.batch_id + ".zip")
+        with stage('zip'):
+            zipfilesindir(workspace.path, filePathZip, uidArray)
     except Exception as e:
+        workspace.cleanup()
         raise HTTPException(status_code=400, detail="Failed zipping PDF")
     resp = FileResponse(filePathZip, media_type="application/x-zip-compressed")
     resp.headers['Content-Disposition'] = 'attachment; filename=bloxbergResearchCertificates'
 
-    file_path = str('./sample_data/pdf_certificates/')
     # Clean up after response
-    background_tasks.add_task(removeTempFiles, file_path, filePathZip, uidArray)
+    background_tasks.add_task(workspace.cleanup)
     return resp
 
 
-def removeTempFiles(file_path, filePathZip, uidArray):
-    os.remove(filePathZip)
-    for x in uidArray:
-        full_path_with_file = str(file_path + x + '.pdf')
-        print(full_path_with_file)
-        os.remove(full_path_with_file)
-
-
-async def buildPDF(content, certificate, generatedID):
-    doc = fitz.open('./bloxbergDataCertificate.pdf')
-    decodedProof = decode_proof(certificate['proof']['proofValue'])
-    blockchainLink = decodedProof['anchors'][0]
-
-    page = doc[0]
-    p1 = fitz.Point(65, 330)
-    p2 = fitz.Point(65, 380)
-    p3 = fitz.Point(65, 430)
-    p4 = fitz.Point(65, 480)
-    cryptographicIdentifier = certificate['crid']
-    transactionIdentifier = blockchainLink.replace('blink:eth:bloxberg:', '')
-    timestamp = certificate['proof']['created']
-    merkleRoot = decodedProof['merkleRoot']
-
-    page.insertText(p1,  # bottom-left of 1st char
-                    cryptographicIdentifier,  # the text (honors '\n')
-                    fontname="helv",  # the default font
-                    stroke_opacity=0.50,
-                    fontsize=11,  # the default font size
-                    rotate=0,  # also available: 90, 180, 270
-                    )
-    page.insertText(p2,  # bottom-left of 1st char
-                    transactionIdentifier,  # the text (honors '\n')
-                    fontname="helv",  # the default font
-                    stroke_opacity=0.50,
-                    fontsize=11,  # the default font size
-                    rotate=0,  # also available: 90, 180, 270
-                    )
-    page.insertText(p3,  # bottom-left of 1st char
-                    timestamp,  # the text (honors '\n')
-                    fontname="helv",  # the default font
-                    stroke_opacity=0.50,
-                    fontsize=11,  # the default font size
-                    rotate=0,  # also available: 90, 180, 270
-                    )
-    page.insertText(p4,  # bottom-left of 1st char
-                    merkleRoot,  # the text (honors '\n')
-                    fontname="helv",  # the default font
-                    stroke_opacity=0.50,
-                    fontsize=11,  # the default font size
-                    rotate=0,  # also available: 90, 180, 270
-                    )
-
-    # QRCode Generation
-    url = pyqrcode.create('https://certify.bloxberg.org/verify', error='L', version=27)
-    buffer = io.BytesIO()
-    url.png(buffer)
-
-    # QR code embedding
-    rect = fitz.Rect(575, 298, 775, 498)  # where we want to put the image
-    pix = fitz.Pixmap(buffer.getvalue())  # any supported image file
-    page.insertImage(rect, pixmap=pix, overlay=True)  # insert image
-    # TODO add .json file ending
-    doc.embeddedFileAdd("bloxbergJSONCertificate", content)
-    doc.save('./sample_data/pdf_certificates/' + generatedID + '.pdf', garbage=4, deflate=True)
+@router.post("/extractCertificates", tags=['pdf'], dependencies=[Depends(api_key_security)])
+async def extractCertificates(request: Request):
+    """
+    Accepts PDF files generated by generatePDF, or zip archives of them, uploaded as multipart form data. Streams
+    back one NDJSON line per PDF in upload order, {"file": ..., "certificate": ...} with the embedded certificate or
+    {"file": ..., "error": ...}.
+
+    PDFs are opened from memory in the render pool. Only a few PDFs of a zip are read at a time, so archives with
+    thousands of entries don't have to fit into memory.
+    """
+    if not request.headers.get('content-type', '').startswith('multipart/form-data'):
+        raise HTTPException(status_code=400, detail="Upload PDF or zip files as multipart form data")
+    form = await request.form()
+    uploads = [upload for _, upload in form.multi_items() if hasattr(upload, 'read')]
+    return StreamingResponse(streamExtractedCertificates(uploads), media_type="application/x-ndjson")
+
+
+async def streamExtractedCertificates(uploads):
+    names = collections.deque()
+    tasks = extractionTasks(uploads, names, get_max_pdf_bytes())
+    try:
+        with in_flight('extract_request'):
+            async for certificate, error in render_ordered(tasks):
+                line = {"file": names.popleft()}
+                if error is None:
+                    line["certificate"] = certificate
+                else:
+                    line["error"] = error
+                yield encodeLine(line)
+    finally:
+        for upload in uploads:
+            await upload.close()
+
+
+def extractionTasks(uploads, names, maxBytes):
+    """
+    Yields a render pool task per PDF and appends its name to names. Uploads are spooled by the form parser, zip
+    entries are read one by one when render_ordered has room for the next task.
+    """
+    count = 0
+    for upload in uploads:
+        if is_zipfile(upload.file):
+            upload.file.seek(0)
+            with ZipFile(upload.file) as archive:
+                for info in archive.infolist():
+                    if info.is_dir() or not info.filename.lower().endswith('.pdf'):
+                        continue
+                    names.append(upload.filename + '/' + info.filename)
+                    count += 1
+                    if info.file_size > maxBytes:
+                        yield rejectPDF, ("PDF exceeds %d bytes" % maxBytes,)
+                        continue
+                    try:
+                        pdfBytes = archive.read(info)
+                    except Exception as e:
+                        yield rejectPDF, ("Could not read zip entry: %s" % e,)
+                        continue
+                    yield tryExtractCertificate, (pdfBytes,)
+        else:
+            upload.file.seek(0)
+            names.append(upload.filename)
+            count += 1
+            pdfBytes = upload.file.read(maxBytes + 1)
+            if len(pdfBytes) > maxBytes:
+                yield rejectPDF, ("PDF exceeds %d bytes" % maxBytes,)
+            else:
+                yield tryExtractCertificate, (pdfBytes,)
+    observe_batch_size('extract_request', count)
+
+
+def encodeLine(value):
+    if orjson is not None:
+        return orjson.dumps(value) + b'\n'
+    return (json.dumps(value) + '\n').encode('utf8')
+
+
+def get_max_pdf_bytes():
+    return int(os.getenv("EXTRACT_MAX_PDF_BYTES", str(50 * 1024 * 1024)))
 
 
 def decode_proof(proofEncoded):
     try:
-        mp2019 = MerkleProof2019()
-        check_decoded = mp2019.decode(proofEncoded)
+        check_decoded = decode_proof_value(proofEncoded)
     except Exception as e:
         print(e)
         raise HTTPException(status_code=400, detail="Invalid Proof Value, could not decode")
     return check_decoded
+
+
+def decode_proofs(certificates):
+    try:
+        decodedProofs = decode_proof_values([certificate.proof['proofValue'] for certificate in certificates])
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=400, detail="Invalid Proof Value, could not decode")
+    return decodedProofs
@@ -1,28 +1,54 @@
 from typing import List, Optional
 from functools import lru_cache
-from fastapi import Depends, FastAPI, Request, HTTPException, status, BackgroundTasks
+from fastapi import Depends, FastAPI, Request, HTTPException, status, BackgroundTasks, Header
 from fastapi.responses import FileResponse, Response, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.encoders import jsonable_encoder
 from fastapi_simple_security import api_key_security
 from cert_tools import instantiate_v3_alpha_certificate_batch, create_v3_alpha_certificate_template
+from controller.batch_workspace import BatchWorkspace
+from controller.metrics import stage, in_flight, observe_batch_size
+from controller.cert_tools.issuer_client import post_to_issuer, stream_from_issuer
+from controller.cert_tools.chunked_issuance import split_chunks, issue_chunks, get_chunk_size, get_chunk_concurrency, \
+    get_max_crids, get_max_stream_crids
+from controller.cert_tools.idempotency import IdempotencyConflict, IdempotencyStore, RequestDeduplicator, hash_body, \
+    derive_key, is_idempotency_enabled, get_idempotency_location, DONE
+from controller.cert_tools.merkle_proof import get_transaction_id
+from controller.cert_tools.result_cache import CertificateResultCache, hash_metadata, is_result_cache_enabled, \
+    get_result_cache_location
+from controller.cert_tools.template_cache import TemplateCache, fingerprint_config, get_template_cache_size, \
+    is_template_persistence_enabled
+from controller.cert_tools.unsigned_certificates import get_certificate_pipeline, instantiate_batch_in_memory
 from pydantic import BaseModel, Field, Json
+from starlette.concurrency import run_in_threadpool
 from urllib.error import HTTPError
 import configargparse
+import collections
 import logging
 from fastapi import APIRouter
 import uuid
 import io
 import os
+import copy
 import httpx
 import time
 import json
 import requests
 import shutil
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logging.basicConfig(format="%(asctime)s %(message)s", datefmt="%m/%d/%Y %I:%M:%S %p")
 logger = logging.getLogger(__name__)
 router = APIRouter()
+result_cache = None
+request_deduplicator = None
+template_config = None
+instantiate_config = None
+template_cache = None
 
 class jsonCertificate(BaseModel):
     context: Optional[List[str]] = Field(
@@ -83,8 +109,9 @@ class Batch(BaseModel):
     publicKey: str = Field(
         description='Public bloxberg address where the Research Object Certificate token will be minted')
     crid: List[str] = Field(
-        description='Cryptographic Identifier of each file you wish to certify. One certificate will be generated per hash up to a maximum of 1001 in a single request',
-        max_length=1001)
+        description='Cryptographic Identifier of each file you wish to certify. One certificate will be generated per hash.'
+                    ' Large batches are split into chunks of up to 1000 certificates, each issued in its own transaction.'
+                    ' Batches of more than 1000 CRIDs have to be requested with stream=true')
     cridType: Optional[str] = Field(
         description='If crid is not self-describing, provide the type of cryptographic function you used to generate the cryptographic identifier.'
                     ' Please use the name field from the multihash list to ensure compatibility: https://github.com/multiformats/multicodec/blob/master/table.csv')
@@ -109,59 +136,373 @@ class Batch(BaseModel):
 
 
 
+def get_template_config():
+    # configargparse files and the environment are parsed once per worker
+    global template_config
+    if template_config is None:
+        template_config = create_v3_alpha_certificate_template.get_config()
+    return template_config
+
+
+def get_instantiate_config():
+    global instantiate_config
+    if instantiate_config is None:
+        instantiate_config = instantiate_v3_alpha_certificate_batch.get_config()
+    return instantiate_config
+
+
+def get_template_cache():
+    global template_cache
+    if template_cache is None:
+        conf = get_template_config()
+        template_cache = TemplateCache(os.path.join(conf.abs_data_dir, conf.template_dir), render_template,
+                                       fingerprint_config(conf), get_template_cache_size(),
+                                       is_template_persistence_enabled())
+    return template_cache
+
+
+def render_template(publicKey, fileName):
+    conf = copy.copy(get_template_config())
+    conf.template_file_name = fileName
+    create_v3_alpha_certificate_template.write_certificate_template(conf, publicKey)
+
+
+def get_unsigned_certificates_root(conf):
+    return str(conf.abs_data_dir + '/' + 'unsigned_certificates')
+
+
 async def issueRequest(url, headers, payload):
-    #Asynchronous
-    async with httpx.AsyncClient() as session:  # use httpx
-        response = await session.request(method='POST', url=url, headers=headers, data=payload, timeout=None)
-    encodedResponse = response.text.encode('utf8')
-    jsonText = json.loads(encodedResponse)
+    # Shared keep-alive client of this worker, see issuer_client
+    return await post_to_issuer(url, headers, payload)
 
-    ## Sync
-    # response = requests.request("POST", url, headers=headers, data=payload)
-    # encodedResponse = response.text.encode('utf8')
-    # jsonText = json.loads(encodedResponse)
 
-    return jsonText
+class PartialCertification(Exception):
+    """
+    Some chunks of a batch failed. result is {"certificates": [...], "failedChunks": [{"chunk", "crids", "error"}]}
+    with the issued certificates in the order of batch.crid.
+    """
+
+    def __init__(self, result):
+        super().__init__(f"Certifying {len(result['failedChunks'])} chunks to the blockchain failed.")
+        self.result = result
 
 
 
 ##Full Workflow
-@router.post("/createBloxbergCertificate", dependencies=[Depends(api_key_security)], tags=['certificate'], response_model=List[jsonCertificate])
-async def createBloxbergCertificate(batch: Batch):
+@router.post("/createBloxbergCertificate", dependencies=[Depends(api_key_security)], tags=['certificate'], response_model=List[jsonCertificate],
+             responses={207: {"description": "Some chunks failed. The body holds the issued certificates in certificates and the CRIDs to resubmit in failedChunks."}})
+async def createBloxbergCertificate(batch: Batch, request: Request, idempotency_key: Optional[str] = Header(None),
+                                    stream: bool = False):
 
     """
     Creates, transacts, and signs a research object certificate on the bloxberg blockchain. Hashes must be generated client side for each desired file and provided in an array. Each hash corresponds to one research object certificate returned in a JSON object array.
+    Resubmitting the same request, with the same Idempotency-Key header or the same body if no key is given, returns the result of the first one instead of certifying again. This holds for streamed requests as well, as long as the CRID result cache is enabled.
+    With stream=true the certificates are sent as newline delimited JSON (application/x-ndjson) while they are received from the issuer. If certifying fails after the response started, the last line is an object with an "error" field. Batches of more than CERTIFY_MAX_CRIDS (1000) CRIDs are only accepted with stream=true.
+    If some chunks of a batch fail, the response has status 207 and the body {"certificates": [...], "failedChunks": [{"chunk", "crids", "error"}]}.
+    """
+    try:
+        if stream:
+            validate_batch(batch, stream=True)
+            certificates = await open_certificate_stream(batch, request, idempotency_key)
+            return StreamingResponse(ndjson_lines(certificates), media_type="application/x-ndjson")
+        if not is_idempotency_enabled():
+            return trusted_response(await certify_batch(batch))
+        bodyHash = hash_body(batch.dict())
+        scope = get_idempotency_scope(request)
+        return trusted_response(await get_request_deduplicator().run(derive_key(scope, idempotency_key, bodyHash),
+                                                                     bodyHash, lambda: certify_batch(batch)))
+    except IdempotencyConflict:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request.")
+    except PartialCertification as e:
+        # Not a completed request, so it is not replayed and a retry issues the failed chunks again
+        return Response(content=encode_json(e.result), status_code=207, media_type="application/json")
+
+
+def get_idempotency_scope(request: Request):
+    return request.headers.get('api-key') or request.query_params.get('api-key')
+
+
+async def open_certificate_stream(batch: Batch, request: Request, idempotency_key: Optional[str]):
+    """
+    Streamed requests hold their idempotency key until the stream is complete, duplicates wait for it like buffered
+    ones. The certificates are too many to store with the key, so a completed duplicate is streamed from the result
+    cache, which only issues CRIDs that failed before. Streamed and buffered requests never share a key.
     """
+    if not is_idempotency_enabled():
+        return certify_batch_stream(batch)
+    bodyHash = hash_body(batch.dict())
+    scope = '\n'.join([get_idempotency_scope(request) or '', 'stream'])
+    key = derive_key(scope, idempotency_key, bodyHash)
+    deduplicator = get_request_deduplicator()
+    state, _ = await deduplicator.claim(key, bodyHash)
+    if state == DONE:
+        if not use_result_cache(batch):
+            raise HTTPException(status_code=409,
+                                detail="This request was already streamed and its certificates are not stored, use a new Idempotency-Key to certify again.")
+        return certify_batch_stream(batch)
+    return deduplicator.stream(key, certify_batch_stream(batch), failed=lambda certificate: "error" in certificate)
 
-    # Currently don't support IPFS due to performance and space issues.
-    if batch.enableIPFS is True:
+
+def trusted_response(certificates):
+    """
+    The certificates are built by cert_issuer_api, with TRUST_ISSUER_RESPONSES=true they are sent as they are instead
+    of being validated against the response model again.
+    """
+    if os.getenv("TRUST_ISSUER_RESPONSES", "false").lower() != "true":
+        return certificates
+    return Response(content=encode_json(certificates), media_type="application/json")
+
+
+def encode_json(value):
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value).encode('utf-8')
+
+
+async def ndjson_lines(certificates):
+    try:
+        async for certificate in certificates:
+            yield encode_json(certificate) + b'\n'
+    except Exception as e:
+        detail = getattr(e, 'detail', None) or "Certifying batch to the blockchain failed."
+        logger.warning('Streaming certificates failed: %s', e)
+        yield encode_json({"error": detail}) + b'\n'
+
+
+def get_request_deduplicator():
+    global request_deduplicator
+    if request_deduplicator is None:
+        store = IdempotencyStore(get_idempotency_location(),
+                                 ttl_seconds=float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "3600")),
+                                 lease_seconds=float(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "900")))
+        request_deduplicator = RequestDeduplicator(store)
+    return request_deduplicator
+
+
+def is_ipfs_enabled():
+    return os.getenv("ENABLE_IPFS", "false").lower() == "true"
+
+
+def validate_batch(batch: Batch, stream: bool = False):
+    # IPFS is off unless enabled for the deployment, it needs an IPFS node with enough storage.
+    if batch.enableIPFS is True and not is_ipfs_enabled():
         raise HTTPException(status_code=400,
                             detail="IPFS is not supported currently due to performance and storage requirements.")
-    # limit number of CRIDs to 1000
-    print(len(batch.crid))
-    if len(batch.crid) >= 1001:
+    # Batches are split into chunks server-side, the limits only bound the memory of a single request. Buffered
+    # responses and jobs keep all certificates, so larger batches have to be streamed.
+    if stream:
+        if len(batch.crid) > get_max_stream_crids():
+            raise HTTPException(status_code=400,
+                                detail=f"You are trying to certify too many files at once, please limit to {get_max_stream_crids()} files per batch.")
+    elif len(batch.crid) > get_max_crids():
         raise HTTPException(status_code=400,
-                            detail="You are trying to certify too many files at once, please limit to 1000 files per batch.")
+                            detail=f"You are trying to certify too many files at once, please limit to {get_max_crids()} files per batch or use stream=true.")
+
+
+async def certify_batch(batch: Batch):
+    """
+    Runs the full certification workflow for one batch. Shared by the blocking endpoint and the job queue workers.
+    CRIDs that are not certified yet are issued in chunks of CERTIFY_CHUNK_SIZE, one transaction each.
+    """
+    validate_batch(batch)
+    observe_batch_size('request', len(batch.crid))
+    with in_flight('certify_request'):
+        return await certify_chunks(batch)
+
+
+async def certify_chunks(batch: Batch):
+    # Retries are answered from the result cache, only CRIDs that were not certified before are issued
+    certified = await lookup_certified(batch)
+    missing = [crid for crid in dict.fromkeys(batch.crid) if crid not in certified]
+    chunks = split_chunks(missing, get_chunk_size())
+    failedChunks = []
+    async for index, chunk, issued, error in issue_chunks(chunks, lambda crids: issue_chunk(batch, crids),
+                                                          get_chunk_concurrency()):
+        if error is not None:
+            logger.warning('Certifying chunk %d of %d failed: %s', index + 1, len(chunks), error)
+            failedChunks.append({"chunk": index, "crids": chunk,
+                                 "error": getattr(error, 'detail', None) or "Certifying batch to the blockchain failed."})
+            continue
+        certified.update(issued)
+        await record_certified(batch, list(issued.values()))
+        notIssued = [crid for crid in chunk if crid not in issued]
+        if notIssued:
+            failedChunks.append({"chunk": index, "crids": notIssued,
+                                 "error": "The issuer returned no certificate for these CRIDs."})
+    certificates = [certified[crid] for crid in batch.crid if crid in certified]
+    if failedChunks and not certificates:
+        raise HTTPException(status_code=404, detail="Certifying batch to the blockchain failed.")
+    if failedChunks:
+        # The transactions of the other chunks are mined, their certificates are returned with the failed CRIDs
+        raise PartialCertification({"certificates": certificates, "failedChunks": failedChunks})
+    return certificates
+
+
+async def certify_batch_stream(batch: Batch):
+    """
+    Streaming counterpart of certify_batch, yields the certificates in the order of batch.crid while the chunks are
+    issued. A CRID of a failed chunk is answered with {"crid", "chunk", "error"} instead of a certificate. The batch
+    must have passed validate_batch.
+    """
+    observe_batch_size('request', len(batch.crid))
+    certified = await lookup_certified(batch)
+    missing = [crid for crid in dict.fromkeys(batch.crid) if crid not in certified]
+    chunks = split_chunks(missing, get_chunk_size())
+    chunkOf = {crid: index for index, chunk in enumerate(chunks) for crid in chunk}
+    # Issued certificates are only kept when their CRID is requested again later in the batch
+    remaining = collections.Counter(batch.crid)
+    results = issue_chunks(chunks, lambda crids: issue_chunk_streamed(batch, crids), get_chunk_concurrency())
+    index, issued = -1, {}
+    with in_flight('certify_request'):
+        try:
+            for crid in batch.crid:
+                remaining[crid] -= 1
+                if crid in certified:
+                    certificate = certified[crid] if remaining[crid] else certified.pop(crid)
+                else:
+                    while index < chunkOf[crid]:
+                        index, chunk, issued, error = await results.__anext__()
+                        if error is not None:
+                            logger.warning('Certifying chunk %d of %d failed: %s', index + 1, len(chunks), error)
+                            issued = {}
+                        else:
+                            await record_certified(batch, list(issued.values()))
+                    certificate = issued.pop(crid, None)
+                    if certificate is None:
+                        certificate = {"crid": crid, "chunk": index,
+                                       "error": "Certifying batch to the blockchain failed."}
+                    elif remaining[crid]:
+                        certified[crid] = certificate
+                yield certificate
+        finally:
+            await results.aclose()
 
-    conf = create_v3_alpha_certificate_template.get_config()
+
+async def issue_chunk(batch: Batch, crids):
+    """ Issues one chunk and returns crid -> certificate. """
+    observe_batch_size('chunk', len(crids))
+    issued = await issue_crids(batch, crids)
+    return {certificate['crid']: certificate for certificate in issued}
+
+
+async def issue_chunk_streamed(batch: Batch, crids):
+    observe_batch_size('chunk', len(crids))
+    return {certificate['crid']: certificate async for certificate in stream_issued_crids(batch, crids)}
+
+
+def use_result_cache(batch: Batch):
+    # The IPFS manifest belongs to a single batch, so those batches are always issued in full
+    return batch.enableIPFS is not True and is_result_cache_enabled()
+
+
+async def lookup_certified(batch: Batch):
+    if not use_result_cache(batch):
+        return {}
+    return await run_in_threadpool(get_result_cache().lookup, batch.publicKey, batch.crid, batch.cridType,
+                                   hash_metadata(batch.metadataJson))
+
+
+async def record_certified(batch: Batch, certificates):
+    if not use_result_cache(batch):
+        return
+    try:
+        await run_in_threadpool(store_certified, get_result_cache(), batch, hash_metadata(batch.metadataJson),
+                                certificates)
+    except Exception as e:
+        logger.warning('Could not record certified CRIDs: %s', e)
+
+
+def get_result_cache():
+    global result_cache
+    if result_cache is None:
+        result_cache = CertificateResultCache(get_result_cache_location())
+    return result_cache
+
+
+def store_certified(cache, batch, metadataHash, certificates):
+    tx_ids = []
+    for certificate in certificates:
+        try:
+            tx_ids.append(get_transaction_id(certificate['proof']['proofValue']))
+        except Exception:
+            tx_ids.append(None)
+    cache.store(batch.publicKey, batch.cridType, metadataHash, certificates, tx_ids)
+
+
+async def issue_crids(batch: Batch, crids):
+    """
+    Generates, issues and signs one certificate per CRID of the list for the batch's publicKey and metadata.
+    """
+    url, headers, payload, workspace = prepare_issuance(batch, crids)
+    try:
+        start2 = time.time()
+        logger.info('starting cert-issuance')
+        # TODO: Currently a simple post request, but need to research message queues for microservices
+        try:
+            with stage('issuer_request'), in_flight('issuer_request'):
+                jsonText = await issueRequest(url, headers, payload)
+        except Exception as e:
+            print('Bad post request')
+            print(e)
+            raise HTTPException(status_code=404, detail="Certifying batch to the blockchain failed.")
+    finally:
+        if workspace is not None:
+            workspace.cleanup()
+    end2 = time.time()
+    logger.info(end2 - start2)
+    return jsonText
+
+
+async def stream_issued_crids(batch: Batch, crids):
+    """ Like issue_crids, but yields the signed certificates one by one as the issuer streams them. """
+    url, headers, payload, workspace = prepare_issuance(batch, crids)
+    try:
+        with stage('issuer_request'), in_flight('issuer_request'):
+            async for certificate in stream_from_issuer(url, headers, payload):
+                yield certificate
+    finally:
+        if workspace is not None:
+            workspace.cleanup()
+
+
+def prepare_issuance(batch: Batch, crids):
+    """
+    Generates the unsigned certificates and returns (url, headers, payload, workspace) of the issuer request. The
+    workspace, if any, has to be cleaned up once the issuer answered.
+    """
+    conf = get_template_config()
+    inMemory = get_certificate_pipeline() == "memory"
 
     python_environment = os.getenv("app")
-    if python_environment == "production":
-        full_path_with_file = str(conf.abs_data_dir + '/' + 'unsigned_certificates/')
-        for file_name in os.listdir(full_path_with_file):
-            if file_name.endswith('.json'):
-                logger.info(full_path_with_file + file_name)
-                os.remove(full_path_with_file + file_name)
 
     logger.info('Generating unsigned certs')
-    create_v3_alpha_certificate_template.write_certificate_template(conf, batch.publicKey)
-    conf_instantiate = instantiate_v3_alpha_certificate_batch.get_config()
-    if batch.metadataJson is not None:
-        uidArray = instantiate_v3_alpha_certificate_batch.instantiate_batch(conf_instantiate, batch.publicKey,
-                                                                            batch.crid, batch.cridType, batch.metadataJson)
-    else:
-        uidArray = instantiate_v3_alpha_certificate_batch.instantiate_batch(conf_instantiate, batch.publicKey,
-                                                                            batch.crid, batch.cridType)
+    # Rendered once per publicKey, repeat issuers get the cached template and its file
+    with stage('template_write'):
+        template, templateFileName = get_template_cache().get(batch.publicKey)
+    # In file mode the unsigned certificates go to a directory owned by this batch, so concurrent batches never see
+    # or remove each other's files. The issuer reads them from <unsigned_certificates>/<batchId>.
+    workspace = None
+    try:
+        with stage('batch_instantiation'):
+            if inMemory:
+                unsignedCertificates = instantiate_batch_in_memory(template, crids, batch.cridType,
+                                                                   batch.metadataJson)
+                uidArray = list(unsignedCertificates)
+            else:
+                workspace = BatchWorkspace(get_unsigned_certificates_root(conf))
+                conf_instantiate = copy.copy(get_instantiate_config())
+                conf_instantiate.unsigned_certificates_dir = workspace.path
+                conf_instantiate.template_file_name = templateFileName
+                if batch.metadataJson is not None:
+                    uidArray = instantiate_v3_alpha_certificate_batch.instantiate_batch(conf_instantiate, batch.publicKey,
+                                                                                        crids, batch.cridType, batch.metadataJson)
+                else:
+                    uidArray = instantiate_v3_alpha_certificate_batch.instantiate_batch(conf_instantiate, batch.publicKey,
+                                                                                        crids, batch.cridType)
+    except Exception:
+        if workspace is not None:
+            workspace.cleanup()
+        raise
     if python_environment == "production":
         cert_issuer_address = os.getenv("CERT_ISSUER_CONTAINER")
         url = "http://" + cert_issuer_address + "/issueBloxbergCertificate"
@@ -170,32 +511,11 @@ async def createBloxbergCertificate(batch: Batch):
 
     payload = {"recipientPublickey": batch.publicKey, "unSignedCerts": uidArray, "enableIPFS": batch.enableIPFS
               }
+    if inMemory:
+        payload["unSignedCertificates"] = list(unsignedCertificates.values())
+    else:
+        payload["batchId"] = workspace.batch_id
     headers = {
         'Content-Type': 'application/json'
     }
-    payload = json.dumps(payload)
-    start2 = time.time()
-    logger.info('starting cert-issuance')
-    # TODO: Currently a simple post request, but need to research message queues for microservices
-    try:
-        jsonText = await issueRequest(url, headers, payload)
-        for x in uidArray:
-            full_path_with_file = str(conf.abs_data_dir + '/' + 'unsigned_certificates/' + x + '.json')
-            os.remove(full_path_with_file)
-    except Exception as e:
-        print('Bad post request')
-        print(e)
-        try:
-            for x in uidArray:
-                full_path_with_file = str(conf.abs_data_dir + '/' + 'unsigned_certificates/' + x + '.json')
-                os.remove(full_path_with_file)
-                full_path_with_pdf = str(conf.abs_data_dir + '/' + 'pdf_certificates/' + x + '.pdf')
-                os.remove(full_path_with_pdf)
-        except Exception as e:
-            print(e)
-        raise HTTPException(status_code=404, detail="Certifying batch to the blockchain failed.")
-    end2 = time.time()
-    logger.info(end2 - start2)
-    return jsonText
-
-
+    return url, headers, payload, workspace
@@ -0,0 +1,179 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from controller.sqlite_transaction import connect
+
+logger = logging.getLogger(__name__)
+
+RUN = "run"
+WAIT = "wait"
+DONE = "done"
+CONFLICT = "conflict"
+# Stored instead of the result for streamed requests, their certificates are too large to keep with the key
+STREAMED = {"streamed": True}
+
+
+class IdempotencyConflict(Exception):
+    """ The idempotency key was already used for a request with a different body. """
+
+
+class IdempotencyStore:
+    """
+    Idempotency keys in the local SQLite database, shared by all gunicorn workers. A key is either running, leased to
+    the worker executing the request, or done with the result that is replayed until the TTL expires.
+    """
+
+    def __init__(self, db_location, ttl_seconds=3600, lease_seconds=900):
+        self.db_location = db_location
+        self.ttl_seconds = ttl_seconds
+        # A running key whose lease expired is assumed to belong to a dead worker and is taken over.
+        self.lease_seconds = lease_seconds
+        with connect(self.db_location) as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS idempotency_keys (
+                    idempotency_key TEXT PRIMARY KEY,
+                    body_hash TEXT,
+                    status TEXT,
+                    result TEXT,
+                    expires REAL)""")
+            connection.execute("CREATE INDEX IF NOT EXISTS idempotency_keys_expires ON idempotency_keys (expires)")
+
+    def begin(self, key, body_hash):
+        """ Returns (RUN, None) if the caller now owns the key, (DONE, result), (WAIT, None) or (CONFLICT, None). """
+        now = time.time()
+        with connect(self.db_location) as connection:
+            row = connection.execute("SELECT * FROM idempotency_keys WHERE idempotency_key = ?", (key,)).fetchone()
+            if row is not None and row["expires"] > now:
+                if row["body_hash"] != body_hash:
+                    return CONFLICT, None
+                if row["status"] == DONE:
+                    return DONE, json.loads(row["result"])
+                return WAIT, None
+            connection.execute(
+                "INSERT OR REPLACE INTO idempotency_keys (idempotency_key, body_hash, status, expires) "
+                "VALUES (?, ?, ?, ?)", (key, body_hash, RUN, now + self.lease_seconds))
+        return RUN, None
+
+    def complete(self, key, result):
+        now = time.time()
+        with connect(self.db_location) as connection:
+            connection.execute(
+                "UPDATE idempotency_keys SET status = ?, result = ?, expires = ? WHERE idempotency_key = ?",
+                (DONE, json.dumps(result), now + self.ttl_seconds, key))
+            connection.execute("DELETE FROM idempotency_keys WHERE expires < ?", (now,))
+
+    def abandon(self, key):
+        # Failed requests are not replayed, the next attempt runs again
+        with connect(self.db_location) as connection:
+            connection.execute("DELETE FROM idempotency_keys WHERE idempotency_key = ? AND status = ?", (key, RUN))
+
+
+class RequestDeduplicator:
+    """
+    Runs a request once per idempotency key. Duplicates arriving at the same worker await the in-flight future,
+    duplicates at other workers poll the shared store until the result is recorded, and later duplicates get the
+    stored result until it expires.
+    """
+
+    def __init__(self, store, poll_interval=0.5):
+        self.store = store
+        self.poll_interval = poll_interval
+        self.inflight = {}
+
+    async def run(self, key, body_hash, handler):
+        future = self.inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = asyncio.get_event_loop().create_future()
+        # Nobody may be waiting for the future, so its exception is retrieved here to avoid a warning
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.inflight[key] = future
+        try:
+            result = await self._run_once(key, body_hash, handler)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self.inflight[key]
+        return result
+
+    async def _run_once(self, key, body_hash, handler):
+        state, result = await self.claim(key, body_hash)
+        if state == DONE:
+            return result
+        try:
+            result = await handler()
+        except BaseException:
+            await self.abandon(key)
+            raise
+        await self.complete(key, result)
+        return result
+
+    async def claim(self, key, body_hash):
+        """
+        Waits until the key is done, returning (DONE, result), or owned by the caller, returning (RUN, None). The
+        owner has to complete or abandon the key.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            state, result = await loop.run_in_executor(None, self.store.begin, key, body_hash)
+            if state == CONFLICT:
+                raise IdempotencyConflict(key)
+            if state != WAIT:
+                return state, result
+            await asyncio.sleep(self.poll_interval)
+
+    async def complete(self, key, result):
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self.store.complete, key, result)
+        except Exception as e:
+            logger.warning('Could not record the result of idempotency key %s: %s', key, e)
+
+    async def abandon(self, key):
+        await asyncio.get_event_loop().run_in_executor(None, self.store.abandon, key)
+
+    async def stream(self, key, items, failed=lambda item: False):
+        """
+        Yields the items of a stream whose key the caller claimed. Once all items were sent and none of them failed,
+        the key is completed with STREAMED, otherwise it is abandoned so a retry runs again.
+        """
+        completed = False
+        any_failed = False
+        try:
+            async for item in items:
+                any_failed = any_failed or failed(item)
+                yield item
+            completed = not any_failed
+        finally:
+            if completed:
+                await self.complete(key, STREAMED)
+            else:
+                await self.abandon(key)
+
+
+def hash_body(body):
+    encoded = json.dumps(body, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def derive_key(scope, idempotency_key, body_hash):
+    """ Keys are scoped to the API key, without an Idempotency-Key header the body hash is the key. """
+    key = 'key:' + idempotency_key if idempotency_key else 'body:' + body_hash
+    return hashlib.sha256('\n'.join([scope or '', key]).encode('utf-8')).hexdigest()
+
+
+def is_idempotency_enabled():
+    return os.getenv("IDEMPOTENCY_ENABLED", "true").lower() == "true"
+
+
+def get_idempotency_location():
+    # The SQLite volume of certify-api.yml, see get_job_queue_location
+    return os.getenv("IDEMPOTENCY_DB_LOCATION", "/app/sqlite.db")
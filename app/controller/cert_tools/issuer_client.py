@@ -0,0 +1,80 @@
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import random
+import httpx
+
+logger = logging.getLogger(__name__)
+
+client = None
+
+# Failures where the request never reached cert_issuer_api, so sending it again can't issue a batch twice.
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+def create_issuer_client():
+    limits = httpx.Limits(max_connections=int(os.getenv("ISSUER_MAX_CONNECTIONS", "20")),
+                          max_keepalive_connections=int(os.getenv("ISSUER_MAX_KEEPALIVE_CONNECTIONS", "10")))
+    # Issuing waits for the transaction receipt, so the read timeout has to cover a slow block
+    timeout = httpx.Timeout(float(os.getenv("ISSUER_TIMEOUT_SECONDS", "600")),
+                            connect=float(os.getenv("ISSUER_CONNECT_TIMEOUT_SECONDS", "5")))
+    http2 = importlib.util.find_spec("h2") is not None
+    return httpx.AsyncClient(limits=limits, timeout=timeout, http2=http2)
+
+
+def get_issuer_client():
+    global client
+    if client is None:
+        client = create_issuer_client()
+    return client
+
+
+async def close_issuer_client():
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
+
+
+async def post_to_issuer(url, headers, payload):
+    """
+    POSTs the payload to cert_issuer_api with the shared keep-alive client and returns the decoded JSON response.
+    Only connection failures are retried, with exponential backoff, since the issuance itself is not idempotent.
+    """
+    response = await send_with_retries(get_issuer_client().build_request("POST", url, headers=headers, json=payload))
+    response.raise_for_status()
+    return response.json()
+
+
+async def stream_from_issuer(url, headers, payload):
+    """
+    POSTs the payload to cert_issuer_api with stream=true and yields the certificates of the newline delimited JSON
+    response one by one, without holding the whole response.
+    """
+    request = get_issuer_client().build_request("POST", url, headers=headers, json=payload, params={"stream": "true"})
+    response = await send_with_retries(request, stream=True)
+    try:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        await response.aclose()
+
+
+async def send_with_retries(request, stream=False):
+    retries = int(os.getenv("ISSUER_RETRIES", "3"))
+    backoff = float(os.getenv("ISSUER_RETRY_BACKOFF_SECONDS", "0.5"))
+    attempt = 0
+    while True:
+        try:
+            return await get_issuer_client().send(request, stream=stream)
+        except RETRYABLE_ERRORS as e:
+            if attempt >= retries:
+                raise
+            delay = backoff * 2 ** attempt * (1 + random.random())
+            logger.warning('Could not reach cert_issuer_api (%s), retrying in %.1fs', e, delay)
+            attempt += 1
+            await asyncio.sleep(delay)
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from controller.sqlite_transaction import connect
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+
+
+class JobQueue:
+    """
+    Durable certification job queue stored in the local SQLite database. Every gunicorn worker opens the same file,
+    so a job submitted to one worker can be drained by any other one.
+    """
+
+    def __init__(self, db_location, lease_seconds=3600):
+        self.db_location = db_location
+        # A job that stays in RUNNING longer than the lease is assumed to belong to a dead worker and is requeued.
+        self.lease_seconds = lease_seconds
+        with self._connect() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS certification_jobs (
+                    job_id TEXT PRIMARY KEY,
+                    status TEXT,
+                    payload TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created REAL,
+                    updated REAL)""")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS certification_jobs_status ON certification_jobs (status, created)")
+
+    def _connect(self):
+        return connect(self.db_location)
+
+    def submit(self, payload):
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT INTO certification_jobs (job_id, status, payload, created, updated) VALUES (?, ?, ?, ?, ?)",
+                (job_id, QUEUED, json.dumps(payload), now, now))
+        return job_id
+
+    def claim(self):
+        """ Atomically moves the oldest queued job to RUNNING and returns (job_id, payload), or None if idle. """
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE certification_jobs SET status = ?, updated = ? WHERE status = ? AND updated < ?",
+                (QUEUED, now, RUNNING, now - self.lease_seconds))
+            row = connection.execute(
+                "SELECT job_id, payload FROM certification_jobs WHERE status = ? ORDER BY created LIMIT 1",
+                (QUEUED,)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE certification_jobs SET status = ?, updated = ? WHERE job_id = ?",
+                               (RUNNING, now, row["job_id"]))
+        return row["job_id"], json.loads(row["payload"])
+
+    def finish(self, job_id, result):
+        with self._connect() as connection:
+            connection.execute("UPDATE certification_jobs SET status = ?, result = ?, updated = ? WHERE job_id = ?",
+                               (FINISHED, json.dumps(result), time.time(), job_id))
+
+    def fail(self, job_id, error):
+        with self._connect() as connection:
+            connection.execute("UPDATE certification_jobs SET status = ?, error = ?, updated = ? WHERE job_id = ?",
+                               (FAILED, error, time.time(), job_id))
+
+    def get(self, job_id):
+        with self._connect() as connection:
+            row = connection.execute("SELECT * FROM certification_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = {"jobId": row["job_id"], "status": row["status"], "created": row["created"],
+               "updated": row["updated"]}
+        if row["result"] is not None:
+            job["result"] = json.loads(row["result"])
+        if row["error"] is not None:
+            job["error"] = row["error"]
+        return job
+
+
+class JobWorkerPool:
+    """ Runs `worker_count` asyncio tasks that drain the queue and hand each payload to the `handler` coroutine. """
+
+    def __init__(self, queue, handler, worker_count, poll_interval=1.0):
+        self.queue = queue
+        self.handler = handler
+        self.worker_count = worker_count
+        self.poll_interval = poll_interval
+        self.tasks = []
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        self.tasks = [loop.create_task(self._work()) for _ in range(self.worker_count)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def _work(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                claimed = await loop.run_in_executor(None, self.queue.claim)
+            except sqlite3.Error as e:
+                logger.warning('Could not claim certification job: %s', e)
+                claimed = None
+            if claimed is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            await self.run_job(*claimed)
+
+    async def run_job(self, job_id, payload):
+        loop = asyncio.get_event_loop()
+        logger.info('Running certification job %s', job_id)
+        try:
+            result = await self.handler(payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            detail = getattr(e, 'detail', None) or str(e) or type(e).__name__
+            logger.info('Certification job %s failed: %s', job_id, detail)
+            await loop.run_in_executor(None, self.queue.fail, job_id, detail)
+            return
+        await loop.run_in_executor(None, self.queue.finish, job_id, result)
+
+
+def get_job_queue_location():
+    # The SQLite volume of certify-api.yml, a relative path would end up in the cert-tools checkout (working_dir)
+    return os.getenv("JOB_QUEUE_DB_LOCATION", "/app/sqlite.db")
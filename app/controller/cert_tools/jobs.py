@@ -0,0 +1,68 @@
+from fastapi import Depends, APIRouter, HTTPException
+from fastapi_simple_security import api_key_security
+from starlette.concurrency import run_in_threadpool
+from controller.cert_tools.generate_unsigned_certificate import Batch, PartialCertification, certify_batch, \
+    validate_batch
+from controller.cert_tools.job_queue import JobQueue, JobWorkerPool, get_job_queue_location
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+job_queue = None
+worker_pool = None
+
+
+def get_job_queue():
+    global job_queue
+    if job_queue is None:
+        job_queue = JobQueue(get_job_queue_location(), lease_seconds=int(os.getenv("JOB_LEASE_SECONDS", "3600")))
+    return job_queue
+
+
+async def run_certification_job(payload):
+    # The payload was validated when the job was submitted, so it is rebuilt without validating again.
+    try:
+        return await certify_batch(Batch.construct(**payload))
+    except PartialCertification as e:
+        # The job finishes with the issued certificates and the failed chunks to resubmit
+        return e.result
+
+
+def start_job_workers():
+    global worker_pool
+    worker_count = int(os.getenv("JOB_WORKERS", "2"))
+    if worker_count <= 0:
+        return
+    worker_pool = JobWorkerPool(get_job_queue(), run_certification_job, worker_count)
+    worker_pool.start()
+    logger.info('Started %d certification job workers', worker_count)
+
+
+async def stop_job_workers():
+    global worker_pool
+    if worker_pool is not None:
+        await worker_pool.stop()
+        worker_pool = None
+
+
+@router.post("/jobs", dependencies=[Depends(api_key_security)], tags=['certificate'], status_code=202)
+async def submitBloxbergCertificateJob(batch: Batch):
+    """
+    Queues the same workflow as createBloxbergCertificate and returns a job id immediately. Poll /jobs/{jobId} for the status and, once finished, the certificates.
+    """
+    validate_batch(batch)
+    job_id = await run_in_threadpool(get_job_queue().submit, batch.dict())
+    return {"jobId": job_id, "status": "queued"}
+
+
+@router.get("/jobs/{job_id}", dependencies=[Depends(api_key_security)], tags=['certificate'])
+async def getBloxbergCertificateJob(job_id: str):
+    """
+    Returns the status of a queued certification job. Finished jobs include the certificates in the result field, or {"certificates": [...], "failedChunks": [...]} if some chunks failed.
+    """
+    job = await run_in_threadpool(get_job_queue().get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
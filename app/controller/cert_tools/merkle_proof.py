@@ -0,0 +1,43 @@
+from functools import lru_cache
+from lds_merkle_proof_2019.merkle_proof_2019 import MerkleProof2019
+import os
+
+PROOF_CACHE_SIZE = int(os.getenv("PROOF_CACHE_SIZE", "4096"))
+
+
+@lru_cache(maxsize=1)
+def get_proof_decoder():
+    return MerkleProof2019()
+
+
+@lru_cache(maxsize=PROOF_CACHE_SIZE)
+def decode_proof_value(proofEncoded):
+    """
+    Decodes a MerkleProof2019 proofValue with the shared decoder. Results are cached, callers must not modify them.
+    """
+    return get_proof_decoder().decode(proofEncoded)
+
+
+def decode_proof_values(proofsEncoded):
+    """
+    Decodes the proofs of a whole request in order. Identical proofs, e.g. a certificate sent twice, are decoded once.
+    """
+    decoded = {}
+    for proofEncoded in proofsEncoded:
+        if proofEncoded not in decoded:
+            decoded[proofEncoded] = decode_proof_value(proofEncoded)
+    return [decoded[proofEncoded] for proofEncoded in proofsEncoded]
+
+
+def get_transaction_id(proofEncoded):
+    """ Transaction id from the blink anchor of a proof, e.g. blink:eth:bloxberg:0x..., or None if it has none. """
+    return get_anchor(decode_proof_value(proofEncoded))[1]
+
+
+def get_anchor(decodedProof):
+    """ (chain, transaction id) of the blink anchor of a decoded proof, e.g. ('eth:bloxberg', '0x...'). """
+    for anchor in decodedProof.get('anchors', []):
+        if anchor.startswith('blink:'):
+            chain, _, tx_id = anchor[len('blink:'):].rpartition(':')
+            return chain, tx_id
+    return None, None
@@ -0,0 +1,59 @@
+import hashlib
+
+TARGET_HASH_MISMATCH = "target hash mismatch"
+MERKLE_ROOT_MISMATCH = "merkle root mismatch"
+INVALID_CERTIFICATE = "invalid certificate"
+
+
+class MerklePathVerifier:
+    """
+    Recomputes Merkle roots from MerkleProof2019 paths. Certificates of one batch share the upper levels of their
+    paths and every node is hashed once per verifier, so a request with many certificates of the same batch costs
+    about one hash per tree node instead of one per path step.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+
+    def root(self, target_hash, path):
+        node = target_hash.lower()
+        for step in path:
+            if 'left' in step:
+                pair = (step['left'].lower(), node)
+            elif 'right' in step:
+                pair = (node, step['right'].lower())
+            else:
+                raise ValueError('Invalid Merkle path step %r' % step)
+            parent = self.nodes.get(pair)
+            if parent is None:
+                parent = hashlib.sha256(bytes.fromhex(pair[0]) + bytes.fromhex(pair[1])).hexdigest()
+                self.nodes[pair] = parent
+            node = parent
+        return node
+
+
+def hash_certificate(certificate, normalize):
+    """ Target hash of a certificate as cert_issuer computes it, sha256 of the normalized document without proof. """
+    unsigned = {key: value for key, value in certificate.items() if key != 'proof'}
+    return hashlib.sha256(normalize(unsigned).encode('utf-8')).hexdigest()
+
+
+def check_certificates(certificates, decodedProofs, normalize):
+    """
+    Checks the target hash and Merkle path of each certificate against its decoded proof. Returns None for every
+    certificate whose proof leads to its merkleRoot, otherwise the reason it failed.
+    """
+    verifier = MerklePathVerifier()
+    results = []
+    for certificate, decodedProof in zip(certificates, decodedProofs):
+        try:
+            targetHash = hash_certificate(certificate, normalize)
+            if targetHash != decodedProof['targetHash'].lower():
+                results.append(TARGET_HASH_MISMATCH)
+            elif verifier.root(targetHash, decodedProof.get('path', [])) != decodedProof['merkleRoot'].lower():
+                results.append(MERKLE_ROOT_MISMATCH)
+            else:
+                results.append(None)
+        except Exception:
+            results.append(INVALID_CERTIFICATE)
+    return results
@@ -0,0 +1,185 @@
+import asyncio
+import collections
+import concurrent.futures
+import json
+import os
+import io
+import fitz
+import pyqrcode
+from controller.metrics import stage
+
+render_pool = None
+base_document = None
+
+TEMPLATE_PATH = './bloxbergDataCertificate.pdf'
+SAVE_PROFILES = {
+    "compact": {"garbage": 4, "deflate": True},
+    "fast": {"garbage": 1, "deflate": True},
+}
+
+
+def get_render_pool():
+    """
+    Process pool shared by all requests of this worker, PDF_RENDER_WORKERS processes (0 renders in threads instead).
+    """
+    global render_pool
+    if render_pool is None:
+        workers = int(os.getenv("PDF_RENDER_WORKERS", "2"))
+        if workers <= 0:
+            return None
+        render_pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    return render_pool
+
+
+def shutdown_render_pool():
+    global render_pool
+    if render_pool is not None:
+        render_pool.shutdown(wait=False)
+        render_pool = None
+
+
+def get_render_concurrency():
+    """ Maximum number of PDFs of a single request that are queued on the pool at the same time. """
+    return max(1, int(os.getenv("PDF_RENDER_CONCURRENCY", "4")))
+
+
+async def render_ordered(tasks, concurrency=None):
+    """
+    Runs each (function, args) of tasks in the render pool and yields the results in input order. At most
+    `concurrency` tasks are in flight, so one large request can't monopolize the pool and tasks are only pulled from
+    the iterable when there is room.
+    """
+    loop = asyncio.get_event_loop()
+    pool = get_render_pool()
+    concurrency = concurrency or get_render_concurrency()
+    pending = collections.deque()
+    try:
+        for function, args in tasks:
+            pending.append(loop.run_in_executor(pool, function, *args))
+            if len(pending) >= concurrency:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def get_save_options(profile=None):
+    """
+    Keyword arguments for Document.save/write. 'compact' (default) deduplicates and recompresses the whole document.
+    'fast' only deflates the new streams and drops unused objects, which is enough because the base document is
+    already compacted.
+    """
+    profile = profile or os.getenv("PDF_SAVE_PROFILE", "compact")
+    try:
+        return SAVE_PROFILES[profile]
+    except KeyError:
+        raise ValueError("Unknown PDF save profile: " + profile)
+
+
+def buildPDF(content, certificate, decodedProof, pdfPath, saveProfile=None):
+    # Runs in the render pool, its samples are only collected with PROMETHEUS_MULTIPROC_DIR or PDF_RENDER_WORKERS=0
+    with stage('pdf_render'):
+        doc = renderPDF(content, certificate, decodedProof)
+    with stage('pdf_save'):
+        doc.save(pdfPath, **get_save_options(saveProfile))
+    return pdfPath
+
+
+def buildPDFBytes(content, certificate, decodedProof, saveProfile=None):
+    with stage('pdf_render'):
+        doc = renderPDF(content, certificate, decodedProof)
+    with stage('pdf_save'):
+        return doc.write(**get_save_options(saveProfile))
+
+
+def get_base_document():
+    """
+    The certificate template with the verification QR code already embedded, serialized once per process. Every
+    certificate is opened from these bytes, so neither the template file nor the QR code is processed again.
+    """
+    global base_document
+    if base_document is None:
+        doc = fitz.open(TEMPLATE_PATH)
+
+        # QRCode Generation
+        url = pyqrcode.create('https://certify.bloxberg.org/verify', error='L', version=27)
+        buffer = io.BytesIO()
+        url.png(buffer)
+
+        # QR code embedding
+        rect = fitz.Rect(575, 298, 775, 498)  # where we want to put the image
+        pix = fitz.Pixmap(buffer.getvalue())  # any supported image file
+        doc[0].insertImage(rect, pixmap=pix, overlay=True)  # insert image
+        base_document = doc.write(garbage=4, deflate=True)
+    return base_document
+
+
+def renderPDF(content, certificate, decodedProof):
+    doc = fitz.open(stream=get_base_document(), filetype="pdf")
+    blockchainLink = decodedProof['anchors'][0]
+
+    page = doc[0]
+    p1 = fitz.Point(65, 330)
+    p2 = fitz.Point(65, 380)
+    p3 = fitz.Point(65, 430)
+    p4 = fitz.Point(65, 480)
+    cryptographicIdentifier = certificate['crid']
+    transactionIdentifier = blockchainLink.replace('blink:eth:bloxberg:', '')
+    timestamp = certificate['proof']['created']
+    merkleRoot = decodedProof['merkleRoot']
+
+    page.insertText(p1,  # bottom-left of 1st char
+                    cryptographicIdentifier,  # the text (honors '\n')
+                    fontname="helv",  # the default font
+                    stroke_opacity=0.50,
+                    fontsize=11,  # the default font size
+                    rotate=0,  # also available: 90, 180, 270
+                    )
+    page.insertText(p2,  # bottom-left of 1st char
+                    transactionIdentifier,  # the text (honors '\n')
+                    fontname="helv",  # the default font
+                    stroke_opacity=0.50,
+                    fontsize=11,  # the default font size
+                    rotate=0,  # also available: 90, 180, 270
+                    )
+    page.insertText(p3,  # bottom-left of 1st char
+                    timestamp,  # the text (honors '\n')
+                    fontname="helv",  # the default font
+                    stroke_opacity=0.50,
+                    fontsize=11,  # the default font size
+                    rotate=0,  # also available: 90, 180, 270
+                    )
+    page.insertText(p4,  # bottom-left of 1st char
+                    merkleRoot,  # the text (honors '\n')
+                    fontname="helv",  # the default font
+                    stroke_opacity=0.50,
+                    fontsize=11,  # the default font size
+                    rotate=0,  # also available: 90, 180, 270
+                    )
+
+    # TODO add .json file ending
+    doc.embeddedFileAdd("bloxbergJSONCertificate", content)
+    return doc
+
+
+def extractCertificate(pdfBytes):
+    """ The certificate JSON that renderPDF embedded, read from a PDF held in memory. """
+    doc = fitz.open(stream=pdfBytes, filetype="pdf")
+    try:
+        return json.loads(doc.embeddedFileGet("bloxbergJSONCertificate"))
+    finally:
+        doc.close()
+
+
+def tryExtractCertificate(pdfBytes):
+    """ (certificate, None) or (None, error) for one PDF, so a broken file does not end a bulk extraction. """
+    try:
+        return extractCertificate(pdfBytes), None
+    except Exception as e:
+        return None, "No bloxbergJSONCertificate found: %s" % e
+
+
+def rejectPDF(error):
+    return None, error
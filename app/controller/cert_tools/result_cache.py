@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+import time
+from controller.sqlite_transaction import connect
+
+# Stay below SQLITE_MAX_VARIABLE_NUMBER of older SQLite builds
+LOOKUP_CHUNK_SIZE = 500
+
+
+class CertificateResultCache:
+    """
+    Index of issued certificates in the local SQLite database, keyed by (publicKey, crid, cridType, metadata hash).
+    A request repeating CRIDs that were already certified for the same key and metadata is answered from here
+    instead of minting a new transaction.
+    """
+
+    def __init__(self, db_location):
+        self.db_location = db_location
+        with connect(self.db_location) as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS certified_crids (
+                    public_key TEXT,
+                    crid TEXT,
+                    crid_type TEXT,
+                    metadata_hash TEXT,
+                    certificate TEXT,
+                    tx_id TEXT,
+                    created REAL,
+                    PRIMARY KEY (public_key, crid, crid_type, metadata_hash))""")
+
+    def lookup(self, public_key, crids, crid_type, metadata_hash):
+        """ Returns crid -> certificate for the CRIDs of the list that are already certified. """
+        found = {}
+        unique_crids = list(dict.fromkeys(crids))
+        with connect(self.db_location) as connection:
+            for start in range(0, len(unique_crids), LOOKUP_CHUNK_SIZE):
+                chunk = unique_crids[start:start + LOOKUP_CHUNK_SIZE]
+                rows = connection.execute(
+                    "SELECT crid, certificate FROM certified_crids WHERE public_key = ? AND crid_type = ? "
+                    "AND metadata_hash = ? AND crid IN (%s)" % ','.join('?' * len(chunk)),
+                    [public_key, crid_type or '', metadata_hash] + chunk).fetchall()
+                for row in rows:
+                    found[row["crid"]] = json.loads(row["certificate"])
+        return found
+
+    def store(self, public_key, crid_type, metadata_hash, certificates, tx_ids=None):
+        """ Records the issued certificates, tx_ids optionally holds the transaction id of each certificate. """
+        now = time.time()
+        tx_ids = tx_ids or [None] * len(certificates)
+        with connect(self.db_location) as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO certified_crids "
+                "(public_key, crid, crid_type, metadata_hash, certificate, tx_id, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(public_key, certificate["crid"], crid_type or '', metadata_hash, json.dumps(certificate), tx_id, now)
+                 for certificate, tx_id in zip(certificates, tx_ids)])
+
+
+def hash_metadata(metadata):
+    """ Stable hash of the parsed metadataJson, key order does not matter. """
+    if metadata is None:
+        return ''
+    encoded = json.dumps(metadata, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def is_result_cache_enabled():
+    return os.getenv("CRID_CACHE_ENABLED", "true").lower() == "true"
+
+
+def get_result_cache_location():
+    # The SQLite volume of certify-api.yml, see get_job_queue_location
+    return os.getenv("CRID_CACHE_DB_LOCATION", "/app/sqlite.db")
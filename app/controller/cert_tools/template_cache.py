@@ -0,0 +1,91 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+
+class TemplateCache:
+    """
+    Certificate templates per publicKey, rendered once and kept in memory with LRU eviction. Every template is
+    written to its own file in the template directory, the file name carries a fingerprint of the config, so the
+    issuer never reads the template of a different key or config. With persistence those files are also loaded by
+    restarted workers and the other workers of the service instead of rendering the template again.
+    """
+
+    def __init__(self, directory, render, config_fingerprint, max_size=512, persist=True):
+        self.directory = directory
+        # render(public_key, file_name) writes the template of the key to file_name in the directory
+        self.render = render
+        self.config_fingerprint = config_fingerprint
+        self.max_size = max_size
+        self.persist = persist
+        self.templates = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def file_name(self, public_key):
+        key_hash = hashlib.sha256(public_key.encode('utf-8')).hexdigest()[:32]
+        return 'template-%s-%s.json' % (self.config_fingerprint, key_hash)
+
+    def get(self, public_key):
+        """ Returns (template, file name), callers must not modify the template. """
+        file_name = self.file_name(public_key)
+        with self.lock:
+            template = self.templates.get(file_name)
+            if template is not None:
+                self.templates.move_to_end(file_name)
+        if template is not None:
+            if not os.path.exists(os.path.join(self.directory, file_name)):
+                # Removed from disk meanwhile, the issuer still needs it in file mode
+                self._write(file_name, template)
+            return template, file_name
+        template = self._load(file_name) if self.persist else None
+        if template is None:
+            template = self._render(public_key, file_name)
+        with self.lock:
+            self.templates[file_name] = template
+            self.templates.move_to_end(file_name)
+            while len(self.templates) > self.max_size:
+                self.templates.popitem(last=False)
+        return template, file_name
+
+    def _load(self, file_name):
+        try:
+            with open(os.path.join(self.directory, file_name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _render(self, public_key, file_name):
+        # Rendered under a temporary name and moved into place, so concurrent readers never see a partial file
+        temporary = '%s.%s.tmp' % (file_name, uuid.uuid4().hex)
+        try:
+            self.render(public_key, temporary)
+            with open(os.path.join(self.directory, temporary)) as f:
+                template = json.load(f)
+            os.replace(os.path.join(self.directory, temporary), os.path.join(self.directory, file_name))
+        finally:
+            if os.path.exists(os.path.join(self.directory, temporary)):
+                os.remove(os.path.join(self.directory, temporary))
+        return template
+
+    def _write(self, file_name, template):
+        temporary = os.path.join(self.directory, '%s.%s.tmp' % (file_name, uuid.uuid4().hex))
+        with open(temporary, 'w') as f:
+            json.dump(template, f)
+        os.replace(temporary, os.path.join(self.directory, file_name))
+
+
+def fingerprint_config(conf):
+    """ Short hash of the parsed config, templates rendered with a different config get different files. """
+    encoded = json.dumps(vars(conf), sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()[:12]
+
+
+def get_template_cache_size():
+    return int(os.getenv("TEMPLATE_CACHE_SIZE", "512"))
+
+
+def is_template_persistence_enabled():
+    return os.getenv("TEMPLATE_CACHE_PERSIST", "true").lower() == "true"
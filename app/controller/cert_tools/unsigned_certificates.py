@@ -0,0 +1,39 @@
+from datetime import datetime, timezone
+import copy
+import json
+import os
+import uuid
+
+
+def get_certificate_pipeline():
+    """
+    'files' (default) exchanges unsigned certificates with cert_issuer_api through the shared unsigned_certificates
+    directory, 'memory' sends them in the request body and receives the signed certificates inline.
+    """
+    return os.getenv("CERTIFICATE_PIPELINE", "files")
+
+
+def load_certificate_template(conf):
+    template_path = os.path.join(conf.abs_data_dir, conf.template_dir, conf.template_file_name)
+    with open(template_path) as template_file:
+        return json.load(template_file)
+
+
+def instantiate_batch_in_memory(template, crids, crid_type=None, metadata=None):
+    """
+    In-memory counterpart of instantiate_v3_alpha_certificate_batch.instantiate_batch. Returns a dict of
+    uid -> unsigned certificate, in the order of the given crids.
+    """
+    issued_on = datetime.now(timezone.utc).isoformat()
+    metadata_json = json.dumps(metadata) if metadata is not None else None
+    certificates = {}
+    for crid in crids:
+        certificate = copy.deepcopy(template)
+        certificate['issuanceDate'] = issued_on
+        certificate['crid'] = crid
+        if crid_type is not None:
+            certificate['cridType'] = crid_type
+        if metadata_json is not None:
+            certificate['metadataJson'] = metadata_json
+        certificates[str(uuid.uuid4())] = certificate
+    return certificates
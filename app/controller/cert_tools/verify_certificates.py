@@ -0,0 +1,176 @@
+import asyncio
+import os
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi_simple_security import api_key_security
+from starlette.concurrency import run_in_threadpool
+from cert_schema import normalize_jsonld
+from controller.anchor_store import AnchorStore, get_anchor_db_location, get_chain_lookup, is_anchored, normalize_hex
+from controller.metrics import stage, in_flight, observe_batch_size
+from controller.cert_tools.merkle_proof import decode_proof_value, get_anchor
+from controller.cert_tools.merkle_verification import check_certificates
+from controller.cert_tools.pdf_renderer import extractCertificate, render_ordered
+
+router = APIRouter()
+anchor_store = None
+
+VERIFIED = "verified"
+FAILED = "failed"
+# Proof is consistent, but the transaction is neither known locally nor confirmed by a chain lookup
+UNVERIFIED = "unverified"
+
+
+def normalize_certificate(certificate):
+    return normalize_jsonld(certificate, detect_unmapped_fields=False)
+
+
+def verify_chunk(certificates, decodedProofs):
+    # Runs in the render pool, JSON-LD normalization is the expensive part of verifying
+    with stage('verify_chunk'):
+        return check_certificates(certificates, decodedProofs, normalize_certificate)
+
+
+def get_anchor_store():
+    global anchor_store
+    if anchor_store is None:
+        anchor_store = AnchorStore(get_anchor_db_location())
+    return anchor_store
+
+
+def get_verify_chunk_size():
+    return max(1, int(os.getenv("VERIFY_CHUNK_SIZE", "100")))
+
+
+def get_anchor_lookup_concurrency():
+    return max(1, int(os.getenv("ANCHOR_LOOKUP_CONCURRENCY", "8")))
+
+
+@router.post("/verifyCertificates", tags=['verify'], dependencies=[Depends(api_key_security)])
+async def verifyCertificates(request: Request):
+    """
+    Verifies certificates offline. Accepts a JSON array of certificates, as returned by createBloxbergCertificate, or
+    PDF files generated by generatePDF uploaded as multipart form data. Returns one result per certificate in input
+    order with status 'verified', 'failed' (with a reason) or 'unverified' if the anchoring transaction is not known.
+
+    Target hashes and Merkle paths are recomputed locally, anchors are checked against the transactions recorded by
+    cert_issuer_api at issuance and, for unknown transactions, the chain lookup configured with ANCHOR_RPC_URL or
+    ANCHOR_CHAIN_LOOKUP.
+    """
+    certificates = await read_certificates(request)
+    observe_batch_size('verify_request', len(certificates))
+    with in_flight('verify_request'):
+        return await verify_certificates(certificates)
+
+
+async def read_certificates(request: Request):
+    """ The certificates of the request, None for uploaded PDFs without an embedded certificate. """
+    if request.headers.get('content-type', '').startswith('multipart/form-data'):
+        form = await request.form()
+        certificates = []
+        for _, upload in form.multi_items():
+            if not hasattr(upload, 'read'):
+                continue
+            pdfBytes = await upload.read()
+            try:
+                certificates.append(await run_in_threadpool(extractCertificate, pdfBytes))
+            except Exception:
+                certificates.append(None)
+            await upload.close()
+        return certificates
+    try:
+        certificates = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Expected a JSON array of certificates or PDF files")
+    if not isinstance(certificates, list):
+        raise HTTPException(status_code=400, detail="Expected a JSON array of certificates or PDF files")
+    return certificates
+
+
+async def verify_certificates(certificates):
+    results = [{"status": FAILED} for _ in certificates]
+    decodedProofs = {}
+    for index, certificate in enumerate(certificates):
+        if not isinstance(certificate, dict):
+            results[index]["reason"] = "no certificate"
+            continue
+        results[index]["crid"] = certificate.get('crid')
+        try:
+            # Decoded once per distinct proof, see merkle_proof
+            decodedProofs[index] = decode_proof_value(certificate['proof']['proofValue'])
+        except Exception:
+            results[index]["reason"] = "invalid proof"
+            continue
+        results[index]["merkleRoot"] = decodedProofs[index].get('merkleRoot')
+        results[index]["transactionId"] = get_anchor(decodedProofs[index])[1]
+
+    # Target hashes and Merkle paths, in chunks on the render pool
+    indices = list(decodedProofs)
+    chunkSize = get_verify_chunk_size()
+    chunks = [indices[start:start + chunkSize] for start in range(0, len(indices), chunkSize)]
+    tasks = ((verify_chunk, ([certificates[index] for index in chunk], [decodedProofs[index] for index in chunk]))
+             for chunk in chunks)
+    anchored = []
+    chunkIndex = 0
+    async for reasons in render_ordered(tasks):
+        for index, reason in zip(chunks[chunkIndex], reasons):
+            if reason is not None:
+                results[index]["reason"] = reason
+            elif results[index]["transactionId"] is None:
+                results[index]["reason"] = "no transaction anchor"
+            else:
+                anchored.append(index)
+        chunkIndex += 1
+
+    with stage('anchor_check'):
+        confirmed = await check_anchors({(results[index]["transactionId"], results[index]["merkleRoot"])
+                                         for index in anchored})
+    for index in anchored:
+        state = confirmed.get((results[index]["transactionId"], results[index]["merkleRoot"]))
+        if state is True:
+            results[index]["status"] = VERIFIED
+        elif state is False:
+            results[index]["reason"] = "merkle root not anchored in transaction"
+        else:
+            results[index]["status"] = UNVERIFIED
+    return results
+
+
+async def check_anchors(anchors):
+    """
+    Returns (tx_id, merkle root) -> True if the transaction anchors the root, False if it anchors a different one
+    and None if the transaction is unknown. Each distinct transaction is looked up once.
+    """
+    store = get_anchor_store()
+    known = await run_in_threadpool(store.lookup, [tx_id for tx_id, _ in anchors])
+    confirmed = {}
+    missing = []
+    for tx_id, merkleRoot in anchors:
+        knownRoot = known.get(normalize_hex(tx_id))
+        if knownRoot is None:
+            missing.append((tx_id, merkleRoot))
+        else:
+            confirmed[(tx_id, merkleRoot)] = knownRoot == normalize_hex(merkleRoot)
+    chainLookup = get_chain_lookup()
+    if chainLookup is None or not missing:
+        return confirmed
+
+    semaphore = asyncio.Semaphore(get_anchor_lookup_concurrency())
+    transactions = {}
+
+    async def fetch(tx_id):
+        async with semaphore:
+            try:
+                return await run_in_threadpool(chainLookup, tx_id)
+            except Exception as e:
+                print(e)
+                return None
+
+    txIds = list(dict.fromkeys(tx_id for tx_id, _ in missing))
+    for tx_id, transactionInput in zip(txIds, await asyncio.gather(*(fetch(tx_id) for tx_id in txIds))):
+        transactions[tx_id] = transactionInput
+    for tx_id, merkleRoot in missing:
+        if transactions[tx_id] is None:
+            continue
+        confirmed[(tx_id, merkleRoot)] = is_anchored(transactions[tx_id], merkleRoot)
+        if confirmed[(tx_id, merkleRoot)]:
+            await run_in_threadpool(store.add, tx_id, merkleRoot)
+    return confirmed
@@ -6,6 +6,12 @@ from fastapi import FastAPI, HTTPException
 from starlette.middleware.cors import CORSMiddleware
 from fastapi.exceptions import RequestValidationError
 from controller.cert_issuer.router import router as api_router
+from controller.cert_issuer.sign_certificate import get_workspace_root, shutdown_issuance_executor, \
+    stop_ipns_publisher
+from controller.cert_issuer.ipfs_handlers import shutdown_ipfs_uploads
+from controller.batch_workspace import start_sweeper
+from controller.metrics import router as metrics_router, start_rss_sampler
+from controller.profiling import install_profiler, start_session_watcher
 
 logging.basicConfig(format="%(asctime)s %(message)s", datefmt="%m/%d/%Y %I:%M:%S %p")
 logger = logging.getLogger(__name__)
@@ -18,6 +24,10 @@ tags_metadata = [
     }
 ]
 
+workspace_sweeper = None
+rss_sampler = None
+profiling_watcher = None
+
 app = FastAPI(title="Research Object Certification", openapi_tags=tags_metadata)
 
 origins = [
@@ -32,7 +42,28 @@ app.add_middleware(
 )
 
 app.include_router(api_router)
+app.include_router(metrics_router)
+install_profiler(app)
 
 app.add_exception_handler(HTTPException, http_error_handler)
 app.add_exception_handler(RequestValidationError, validation_exception_handler)
 
+
+@app.on_event("startup")
+async def startup():
+    global workspace_sweeper, rss_sampler, profiling_watcher
+    rss_sampler = start_rss_sampler()
+    profiling_watcher = start_session_watcher()
+    workspace_sweeper = start_sweeper([get_workspace_root()])
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    workspace_sweeper.cancel()
+    if rss_sampler is not None:
+        rss_sampler.cancel()
+    if profiling_watcher is not None:
+        profiling_watcher.cancel()
+    await stop_ipns_publisher()
+    shutdown_issuance_executor()
+    shutdown_ipfs_uploads()
\ No newline at end of file
@@ -0,0 +1,120 @@
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import Response
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+BATCH_SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 10000, 25000, 100000)
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, value=1):
+        pass
+
+    def dec(self, value=1):
+        pass
+
+    def set(self, value):
+        pass
+
+
+def is_multiprocess():
+    """
+    gunicorn workers are separate processes, with PROMETHEUS_MULTIPROC_DIR set every process writes its samples to
+    that directory and /metrics of any worker reports the aggregate of all of them.
+    """
+    return bool(os.getenv("PROMETHEUS_MULTIPROC_DIR") or os.getenv("prometheus_multiproc_dir"))
+
+
+if prometheus_client is not None and is_multiprocess():
+    os.makedirs(os.getenv("PROMETHEUS_MULTIPROC_DIR") or os.getenv("prometheus_multiproc_dir"), exist_ok=True)
+
+if prometheus_client is not None:
+    STAGE_SECONDS = prometheus_client.Histogram(
+        'certify_stage_seconds', 'Duration of a stage of the certification and PDF workflows', ['stage'],
+        buckets=STAGE_BUCKETS)
+    BATCH_SIZE = prometheus_client.Histogram(
+        'certify_batch_size', 'Certificates per request, chunk or issued batch', ['kind'], buckets=BATCH_SIZE_BUCKETS)
+    IN_FLIGHT = prometheus_client.Gauge(
+        'certify_in_flight', 'Operations currently in progress', ['operation'], multiprocess_mode='livesum')
+    WORKER_RSS = prometheus_client.Gauge(
+        'certify_worker_resident_memory_bytes', 'Resident memory of the worker process', multiprocess_mode='liveall')
+else:
+    STAGE_SECONDS = BATCH_SIZE = IN_FLIGHT = WORKER_RSS = _NoopMetric()
+
+
+@contextlib.contextmanager
+def stage(name):
+    """ Records the duration of the block as stage `name`, works around awaits as well. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def in_flight(operation):
+    gauge = IN_FLIGHT.labels(operation)
+    gauge.inc()
+    try:
+        yield
+    finally:
+        gauge.dec()
+
+
+def observe_batch_size(kind, size):
+    BATCH_SIZE.labels(kind).observe(size)
+
+
+def sample_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            WORKER_RSS.set(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE'))
+    except (OSError, ValueError):
+        pass
+
+
+async def run_rss_sampler(interval_seconds):
+    while True:
+        sample_rss()
+        await asyncio.sleep(interval_seconds)
+
+
+def start_rss_sampler():
+    """ Every worker samples its own RSS, so the aggregated /metrics shows all of them. """
+    if prometheus_client is None:
+        return None
+    interval_seconds = float(os.getenv("METRICS_RSS_INTERVAL_SECONDS", "15"))
+    return asyncio.get_event_loop().create_task(run_rss_sampler(interval_seconds))
+
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics():
+    if prometheus_client is None:
+        raise HTTPException(status_code=501, detail="Metrics need the prometheus_client package.")
+    sample_rss()
+    if is_multiprocess():
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return Response(prometheus_client.generate_latest(registry), media_type=prometheus_client.CONTENT_TYPE_LATEST)
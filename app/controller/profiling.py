@@ -0,0 +1,324 @@
+import asyncio
+import collections
+import cProfile
+import fcntl
+import glob
+import hmac
+import json
+import logging
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import Response
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+SAMPLE = "sample"
+CPROFILE = "cprofile"
+SESSION_FILE = "session.json"
+
+# Session of this worker, None while profiling is off. The middleware only compares against it.
+active_session = None
+
+
+class ProfileRequest(BaseModel):
+    route: str
+    mode: str = SAMPLE
+    requests: Optional[int] = None
+    seconds: Optional[float] = None
+    allWorkers: bool = True
+    intervalMs: float = 5.0
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "route": "/generatePDF",
+                "mode": "sample",
+                "requests": 20,
+                "seconds": 300,
+                "allWorkers": True,
+                "intervalMs": 5
+            }
+        }
+
+
+class WorkerSession:
+    """
+    Profiling state of one session in this worker. Requests to the route are profiled while the session is active,
+    and the data collected so far is written to <session dir>/<pid>.prof or .collapsed after every request, so the
+    download can merge the files of all workers at any time.
+    """
+
+    def __init__(self, config, root):
+        self.config = config
+        self.id = config["id"]
+        self.route = config["route"]
+        self.mode = config["mode"]
+        self.directory = os.path.join(root, self.id)
+        self.active_requests = 0
+        self.lock = threading.Lock()
+        self.stacks = collections.Counter()
+        self.profile = cProfile.Profile() if self.mode == CPROFILE else None
+        self.sampler = None
+        self.stopped = threading.Event()
+
+    def claim(self):
+        """ Takes one of the session's request slots, shared by all workers through a locked counter file. """
+        limit = self.config.get("requests")
+        if limit is None:
+            return True
+        with open(os.path.join(self.directory, 'claimed'), 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            claimed = int(f.read() or 0)
+            if claimed >= limit:
+                return False
+            f.seek(0)
+            f.truncate()
+            f.write(str(claimed + 1))
+        return True
+
+    def request_started(self):
+        with self.lock:
+            self.active_requests += 1
+            if self.active_requests > 1:
+                return
+            if self.profile is not None:
+                self.profile.enable()
+            elif self.sampler is None:
+                self.sampler = threading.Thread(target=self._sample, name='profiling-sampler', daemon=True)
+                self.sampler.start()
+
+    def request_finished(self):
+        with self.lock:
+            self.active_requests -= 1
+            if self.active_requests == 0 and self.profile is not None:
+                self.profile.disable()
+        self.flush()
+
+    def _sample(self):
+        interval = self.config.get("intervalMs", 5.0) / 1000
+        own_thread = threading.get_ident()
+        names = {}
+        while not self.stopped.wait(interval):
+            if self.active_requests == 0:
+                continue
+            if len(names) != threading.active_count():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                                                  code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, 'thread'))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def flush(self):
+        path = os.path.join(self.directory, str(os.getpid()))
+        with self.lock:
+            if self.profile is not None:
+                if self.active_requests == 0:
+                    self.profile.dump_stats(path + '.prof')
+            else:
+                with open(path + '.collapsed', 'w') as f:
+                    f.writelines('%s %d\n' % (stack, count) for stack, count in list(self.stacks.items()))
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            if self.profile is not None and self.active_requests > 0:
+                self.profile.disable()
+                self.active_requests = 0
+        self.flush()
+
+
+class ProfilingMiddleware:
+    """ ASGI middleware that hands requests to the route of the active session to it, others pass through. """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        session = active_session
+        if session is None or scope["type"] != "http" or scope["path"] != session.route or not session.claim():
+            return await self.app(scope, receive, send)
+        session.request_started()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            session.request_finished()
+
+
+def get_profile_root():
+    return os.getenv("PROFILER_DIR", os.path.join(tempfile.gettempdir(), "cert_api_profiles"))
+
+
+def is_profiler_enabled():
+    return bool(os.getenv("PROFILER_ADMIN_SECRET"))
+
+
+def read_session(root):
+    try:
+        with open(os.path.join(root, SESSION_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def applies_to_this_worker(config):
+    if config is None or config.get("until") is not None and config["until"] < time.time():
+        return False
+    return config.get("pid") is None or config["pid"] == os.getpid()
+
+
+def refresh_session(root):
+    global active_session
+    config = read_session(root)
+    if not applies_to_this_worker(config):
+        config = None
+    if active_session is not None and (config is None or config["id"] != active_session.id):
+        active_session.close()
+        active_session = None
+    if config is not None and active_session is None:
+        active_session = WorkerSession(config, root)
+
+
+async def run_session_watcher(root, interval_seconds):
+    while True:
+        try:
+            refresh_session(root)
+        except Exception as e:
+            logger.warning('Reading the profiling session failed: %s', e)
+        await asyncio.sleep(interval_seconds)
+
+
+def start_session_watcher():
+    """ Only started when PROFILER_ADMIN_SECRET is set, otherwise nothing of the profiler runs. """
+    if not is_profiler_enabled():
+        return None
+    interval_seconds = float(os.getenv("PROFILER_POLL_SECONDS", "1"))
+    return asyncio.get_event_loop().create_task(run_session_watcher(get_profile_root(), interval_seconds))
+
+
+def install_profiler(app):
+    if is_profiler_enabled():
+        app.add_middleware(ProfilingMiddleware)
+    app.include_router(router)
+
+
+def admin_security(x_admin_secret: Optional[str] = Header(None)):
+    secret = os.getenv("PROFILER_ADMIN_SECRET")
+    if not secret or x_admin_secret is None or not hmac.compare_digest(secret, x_admin_secret):
+        raise HTTPException(status_code=403, detail="Profiling needs the admin secret.")
+
+
+def merge_collapsed(paths):
+    stacks = collections.Counter()
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                stacks[stack] += int(count)
+    return ''.join('%s %d\n' % (stack, count) for stack, count in stacks.most_common())
+
+
+def merge_pstats(paths):
+    stats = pstats.Stats(paths[0])
+    for path in paths[1:]:
+        stats.add(path)
+    with tempfile.NamedTemporaryFile(suffix='.prof') as f:
+        stats.dump_stats(f.name)
+        return f.read()
+
+
+@router.post("/admin/profiler", dependencies=[Depends(admin_security)], include_in_schema=False)
+async def startProfiling(profileRequest: ProfileRequest):
+    """
+    Profiles the next `requests` requests to `route`, or those in the next `seconds`, in this worker or all workers.
+    mode 'sample' records stacks of all threads every intervalMs, 'cprofile' traces the event loop thread.
+    """
+    if profileRequest.mode not in (SAMPLE, CPROFILE):
+        raise HTTPException(status_code=400, detail="mode must be 'sample' or 'cprofile'")
+    if profileRequest.requests is None and profileRequest.seconds is None:
+        raise HTTPException(status_code=400, detail="Limit the session with requests or seconds")
+    root = get_profile_root()
+    config = {
+        "id": str(uuid.uuid4()),
+        "route": profileRequest.route,
+        "mode": profileRequest.mode,
+        "requests": profileRequest.requests,
+        "until": time.time() + profileRequest.seconds if profileRequest.seconds is not None else None,
+        "pid": None if profileRequest.allWorkers else os.getpid(),
+        "intervalMs": profileRequest.intervalMs,
+    }
+    os.makedirs(os.path.join(root, config["id"]), exist_ok=True)
+    temporary = os.path.join(root, SESSION_FILE + '.' + config["id"])
+    with open(temporary, 'w') as f:
+        json.dump(config, f)
+    os.replace(temporary, os.path.join(root, SESSION_FILE))
+    refresh_session(root)
+    return {"sessionId": config["id"], "pid": os.getpid()}
+
+
+@router.get("/admin/profiler", dependencies=[Depends(admin_security)], include_in_schema=False)
+async def profilingStatus():
+    root = get_profile_root()
+    config = read_session(root)
+    if config is None:
+        return {"status": "off"}
+    try:
+        with open(os.path.join(root, config["id"], 'claimed')) as f:
+            claimed = int(f.read() or 0)
+    except (OSError, ValueError):
+        claimed = 0
+    expired = config["until"] is not None and config["until"] < time.time()
+    exhausted = config["requests"] is not None and claimed >= config["requests"]
+    return {"status": "finished" if expired or exhausted else "running", "sessionId": config["id"],
+            "route": config["route"], "mode": config["mode"], "profiledRequests": claimed}
+
+
+@router.delete("/admin/profiler", dependencies=[Depends(admin_security)], include_in_schema=False)
+async def stopProfiling():
+    root = get_profile_root()
+    try:
+        os.remove(os.path.join(root, SESSION_FILE))
+    except FileNotFoundError:
+        pass
+    refresh_session(root)
+    return {"status": "stopped"}
+
+
+@router.get("/admin/profiler/{sessionId}", dependencies=[Depends(admin_security)], include_in_schema=False)
+async def downloadProfile(sessionId: str, format: str = "collapsed"):
+    """
+    Merged output of all workers, 'collapsed' stacks for flamegraph tools (sample mode) or 'pstats' (cprofile mode).
+    """
+    try:
+        uuid.UUID(sessionId)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Unknown profiling session")
+    directory = os.path.join(get_profile_root(), sessionId)
+    if format == "pstats":
+        paths = sorted(glob.glob(os.path.join(directory, '*.prof')))
+        if not paths:
+            raise HTTPException(status_code=404, detail="No profiled requests yet")
+        return Response(merge_pstats(paths), media_type="application/octet-stream",
+                        headers={"Content-Disposition": "attachment; filename=%s.prof" % sessionId})
+    if format == "collapsed":
+        paths = sorted(glob.glob(os.path.join(directory, '*.collapsed')))
+        if not paths:
+            raise HTTPException(status_code=404, detail="No profiled requests yet")
+        return Response(merge_collapsed(paths), media_type="text/plain")
+    raise HTTPException(status_code=400, detail="format must be 'collapsed' or 'pstats'")
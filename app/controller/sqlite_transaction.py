@@ -0,0 +1,28 @@
+import sqlite3
+
+
+def connect(db_location):
+    """ Opens the SQLite database shared by the workers of a service, use as `with connect(...) as connection:`. """
+    connection = sqlite3.connect(db_location, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    return Transaction(connection)
+
+
+class Transaction:
+    """ Context manager running the block in a single IMMEDIATE transaction so claims are exclusive across workers. """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.connection.execute("COMMIT")
+            else:
+                self.connection.execute("ROLLBACK")
+        finally:
+            self.connection.close()
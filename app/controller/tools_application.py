@@ -6,6 +6,14 @@ from fastapi import FastAPI, HTTPException
 from starlette.middleware.cors import CORSMiddleware
 from fastapi.exceptions import RequestValidationError
 from controller.cert_tools.router import router as api_router
+from controller.cert_tools import jobs
+from controller.cert_tools.generate_pdf import PDF_WORKSPACE_ROOT
+from controller.cert_tools.pdf_renderer import shutdown_render_pool
+from controller.cert_tools.issuer_client import get_issuer_client, close_issuer_client
+from controller.cert_tools.generate_unsigned_certificate import get_unsigned_certificates_root, get_template_config
+from controller.batch_workspace import start_sweeper
+from controller.metrics import router as metrics_router, start_rss_sampler
+from controller.profiling import install_profiler, start_session_watcher
 
 logging.basicConfig(format="%(asctime)s %(message)s", datefmt="%m/%d/%Y %I:%M:%S %p")
 logger = logging.getLogger(__name__)
@@ -27,6 +35,10 @@ tags_metadata = [
 
 ]
 
+workspace_sweeper = None
+rss_sampler = None
+profiling_watcher = None
+
 app = FastAPI(title="Research Object Certification", openapi_tags=tags_metadata)
 
 origins = [
@@ -41,7 +53,31 @@ app.add_middleware(
 )
 
 app.include_router(api_router)
+app.include_router(metrics_router)
+install_profiler(app)
 
 app.add_exception_handler(HTTPException, http_error_handler)
 app.add_exception_handler(RequestValidationError, validation_exception_handler)
 
+
+@app.on_event("startup")
+async def startup():
+    global workspace_sweeper, rss_sampler, profiling_watcher
+    rss_sampler = start_rss_sampler()
+    profiling_watcher = start_session_watcher()
+    get_issuer_client()
+    jobs.start_job_workers()
+    conf = get_template_config()
+    workspace_sweeper = start_sweeper([get_unsigned_certificates_root(conf), PDF_WORKSPACE_ROOT])
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await jobs.stop_job_workers()
+    workspace_sweeper.cancel()
+    if rss_sampler is not None:
+        rss_sampler.cancel()
+    if profiling_watcher is not None:
+        profiling_watcher.cancel()
+    shutdown_render_pool()
+    await close_issuer_client()
@@ -0,0 +1,24 @@
+from app.controller.anchor_store import AnchorStore, is_anchored
+
+ROOT = "6ad5d5bd0fcd2d5b7d7b6e3b1ef4db2b15a6a6f9d6c8f86b2e6a4a1b4c9b8a7d"
+
+
+def test_lookup_returns_known_transactions(tmp_path):
+    store = AnchorStore(str(tmp_path / "anchors.db"))
+    store.add("0xABC", ROOT, "eth:bloxberg")
+
+    assert store.lookup(["0xabc", "0xdef"]) == {"abc": ROOT}
+    assert store.lookup(["abc"]) == {"abc": ROOT}
+
+
+def test_lookup_of_many_transactions(tmp_path):
+    store = AnchorStore(str(tmp_path / "anchors.db"))
+    for i in range(600):
+        store.add("0x%04x" % i, ROOT)
+    assert len(store.lookup(["0x%04x" % i for i in range(1200)])) == 600
+
+
+def test_root_must_be_part_of_the_transaction_input():
+    assert is_anchored("0x3dfb9a7c" + ROOT.upper() + "00" * 32, "0x" + ROOT)
+    assert not is_anchored("0x3dfb9a7c" + "00" * 32, ROOT)
+    assert not is_anchored(None, ROOT)
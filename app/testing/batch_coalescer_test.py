@@ -0,0 +1,61 @@
+import asyncio
+
+from app.controller.cert_issuer.batch_coalescer import BatchCoalescer
+
+
+def run_requests(coalescer, requests):
+    async def run():
+        return await asyncio.gather(*[coalescer.submit(key, items) for key, items in requests])
+    return asyncio.run(run())
+
+
+def test_concurrent_requests_share_one_issuance():
+    issued = []
+
+    async def issue_batch(key, items):
+        issued.append(list(items))
+        return "0xtx", list(items)
+
+    coalescer = BatchCoalescer(issue_batch, window_seconds=0.05, max_batch_size=1000)
+    results = run_requests(coalescer, [("0xabc", ["a"]), ("0xabc", ["b"]), ("0xabc", ["c", "d"])])
+    assert issued == [["a", "b", "c", "d"]]
+    assert all(result == ("0xtx", ["a", "b", "c", "d"]) for result in results)
+
+
+def test_different_keys_are_not_coalesced():
+    issued = []
+
+    async def issue_batch(key, items):
+        issued.append((key, list(items)))
+        return key
+
+    coalescer = BatchCoalescer(issue_batch, window_seconds=0.05)
+    results = run_requests(coalescer, [("0xabc", ["a"]), ("0xdef", ["b"])])
+    assert results == ["0xabc", "0xdef"]
+    assert sorted(issued) == [("0xabc", ["a"]), ("0xdef", ["b"])]
+
+
+def test_batch_flushes_at_size_limit():
+    issued = []
+
+    async def issue_batch(key, items):
+        issued.append(list(items))
+        return len(items)
+
+    coalescer = BatchCoalescer(issue_batch, window_seconds=10, max_batch_size=2)
+    results = run_requests(coalescer, [("0xabc", ["a"]), ("0xabc", ["b"]), ("0xabc", ["c"]), ("0xabc", ["d"])])
+    assert issued == [["a", "b"], ["c", "d"]]
+    assert results == [2, 2, 2, 2]
+
+
+def test_failure_is_raised_to_every_caller():
+    async def issue_batch(key, items):
+        raise RuntimeError("transaction failed")
+
+    coalescer = BatchCoalescer(issue_batch, window_seconds=0.01)
+
+    async def run():
+        return await asyncio.gather(coalescer.submit("0xabc", ["a"]), coalescer.submit("0xabc", ["b"]),
+                                    return_exceptions=True)
+    results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
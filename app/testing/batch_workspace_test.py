@@ -0,0 +1,43 @@
+import os
+
+from app.controller.batch_workspace import BatchWorkspace, OWNER_FILE, is_valid_batch_id, sweep_orphans
+
+
+def test_cleanup_only_removes_own_files(tmp_path):
+    first = BatchWorkspace(str(tmp_path))
+    second = BatchWorkspace(str(tmp_path))
+    with open(first.file("a.json"), "w") as f:
+        f.write("{}")
+    with open(second.file("b.json"), "w") as f:
+        f.write("{}")
+    first.cleanup()
+    assert not os.path.exists(first.path)
+    assert os.path.exists(second.file("b.json"))
+
+
+def test_workspace_is_removed_on_failure(tmp_path):
+    try:
+        with BatchWorkspace(str(tmp_path)) as workspace:
+            workspace.subdir("unsigned_certificates")
+            raise RuntimeError("issuance failed")
+    except RuntimeError:
+        pass
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_sweeper_only_removes_old_workspaces(tmp_path):
+    old = BatchWorkspace(str(tmp_path))
+    os.utime(os.path.join(old.path, OWNER_FILE), (0, 0))
+    recent = BatchWorkspace(str(tmp_path))
+    unrelated = tmp_path / "unrelated"
+    unrelated.mkdir()
+    assert sweep_orphans([str(tmp_path), str(tmp_path / "missing")], max_age_seconds=60) == 1
+    assert not os.path.exists(old.path)
+    assert os.path.exists(recent.path)
+    assert unrelated.exists()
+
+
+def test_batch_id_must_be_a_uuid():
+    assert is_valid_batch_id("45c5caba-378b-49eb-bf24-b0056d300f22")
+    assert not is_valid_batch_id("../unsigned_certificates")
+    assert not is_valid_batch_id(None)
@@ -0,0 +1,60 @@
+"""
+Measures time and allocations per certificate for the generatePDF serialization on generate_pdf_1000.json, comparing
+the former JSON round-trips with serializeCertificate.
+
+Run from the repository root with the cert_tools dependencies installed:
+
+    python -m app.testing.benchmarks.certificate_serialization
+"""
+import io
+import json
+import sys
+import time
+import tracemalloc
+from os.path import join, dirname, abspath
+
+# The modules import each other as controller.*, the same layout as in the containers
+sys.path.insert(0, abspath(join(dirname(__file__), '..', '..')))
+
+from controller.cert_tools.generate_pdf import jsonCertificate, serializeCertificate
+
+
+def serialize_with_round_trips(certificate):
+    # generatePDF before the single-pass serializer
+    requestJson = certificate.json()
+    certificateJson = json.loads(requestJson)
+    certificateJson['@context'] = certificateJson.pop('context')
+    stringCert = json.dumps(certificateJson)
+    bytestring = io.StringIO(stringCert)
+    content = io.BytesIO(bytestring.read().encode('utf8'))
+    return content, certificateJson
+
+
+def measure(serializer, certificates):
+    start = time.perf_counter()
+    for certificate in certificates:
+        serializer(certificate)
+    elapsed = time.perf_counter() - start
+
+    # Peak memory allocated while serializing one certificate, i.e. the intermediate copies
+    peaks = []
+    for certificate in certificates:
+        tracemalloc.start()
+        serializer(certificate)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return elapsed, sum(peaks) / len(peaks)
+
+
+def main():
+    with open(join(dirname(__file__), '..', 'generate_pdf_1000.json')) as f:
+        certificates = [jsonCertificate(**certificate) for certificate in json.load(f)]
+
+    for name, serializer in (("round trips", serialize_with_round_trips), ("single pass", serializeCertificate)):
+        elapsed, peak = measure(serializer, certificates)
+        print(f"{name:>12}: {1e6 * elapsed / len(certificates):.1f} us/certificate, "
+              f"{peak / 1024:.1f} KiB peak allocation/certificate")
+
+
+if __name__ == '__main__':
+    main()
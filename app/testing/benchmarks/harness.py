@@ -0,0 +1,339 @@
+"""
+Offline benchmark of cert_tools_api and cert_issuer_api. Both FastAPI apps run in-process, the blockchain is replaced by
+a fake ledger with a configurable confirmation latency and ipfshttpclient by a local stub, so no containers, chain or
+IPFS node are needed.
+
+The tools service reads its configuration relative to the working directory, so run the harness from the cert-tools
+checkout, like the cert_tools_api container does:
+
+    cd ../cert-tools
+    python ../cert-api/app/testing/benchmarks/harness.py --output bench_results.json
+
+Results are written as JSON, one entry per endpoint, batch size and concurrency level.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import types
+import uuid
+from os.path import join, dirname, abspath
+
+import httpx
+
+# The apps import their modules as controller.*, the same layout as in the containers
+sys.path.insert(0, abspath(join(dirname(__file__), '..', '..')))
+
+SAMPLE_CERTIFICATES = join(dirname(__file__), '..', 'generate_pdf_1000.json')
+PUBLIC_KEY = "0x69575606E8b8F0cAaA5A3BD1fc5D032024Bb85AF"
+
+
+class FakeCertificateBatchHandler:
+    def __init__(self):
+        self.certificates_to_issue = {}
+
+
+class FakeLedger:
+    """
+    Stands in for ethereum_sc and cert_issuer.issue_certificates.issue. Issuing blocks for `confirmation_latency`
+    seconds like waiting for a receipt, then writes the certificates with a sample MerkleProof2019 proof.
+    """
+
+    def __init__(self, confirmation_latency, proof):
+        self.confirmation_latency = confirmation_latency
+        self.proof = proof
+        self.transactions = 0
+
+    def instantiate_blockchain_handlers(self, config):
+        return FakeCertificateBatchHandler(), object(), object()
+
+    def issue(self, config, certificate_batch_handler, transaction_handler, recipientPublicKey, tokenURI):
+        uids = [file_name[:-len('.json')] for file_name in os.listdir(config.unsigned_certificates_dir)
+                if file_name.endswith('.json')]
+        time.sleep(self.confirmation_latency)
+        for uid in uids:
+            with open(join(config.unsigned_certificates_dir, uid + '.json')) as f:
+                certificate = json.load(f)
+            certificate['proof'] = self.proof
+            with open(join(config.blockchain_certificates_dir, uid + '.json'), 'w') as f:
+                json.dump(certificate, f)
+        certificate_batch_handler.certificates_to_issue = {uid: None for uid in uids}
+        self.transactions += 1
+        return '0x' + uuid.uuid4().hex * 2, self.transactions
+
+
+class StubIPFSClient:
+    """ Local replacement for the ipfshttpclient client, content is only kept in memory. """
+
+    def __init__(self):
+        self.objects = {}
+        self.key = types.SimpleNamespace(gen=self._key_gen, list=lambda: {"Keys": []}, rename=self._key_rename)
+        self.name = types.SimpleNamespace(publish=self._publish)
+
+    def _hash(self, data):
+        object_hash = 'Qm' + uuid.uuid5(uuid.NAMESPACE_OID, repr(data)).hex
+        self.objects[object_hash] = data
+        return object_hash
+
+    def add(self, path, **kwargs):
+        with open(path, 'rb') as f:
+            return {"Hash": self._hash(f.read()), "Name": os.path.basename(path)}
+
+    def add_bytes(self, data, **kwargs):
+        return self._hash(data)
+
+    def add_json(self, json_object, **kwargs):
+        return self._hash(json.dumps(json_object))
+
+    def _key_gen(self, name, key_type, **kwargs):
+        return {"Name": name, "Id": 'k51' + uuid.uuid4().hex}
+
+    def _key_rename(self, old, new, **kwargs):
+        return {"Was": old, "Now": new}
+
+    def _publish(self, path, key=None, **kwargs):
+        return {"Name": key, "Value": path}
+
+    def close(self):
+        pass
+
+
+def install_fakes(ledger, issuer_dirs):
+    import ipfshttpclient
+    import cert_issuer.issue_certificates
+    from cert_issuer.blockchain_handlers import ethereum_sc
+    from controller.cert_issuer import sign_certificate
+
+    stub_client = StubIPFSClient()
+    ipfshttpclient.connect = lambda *args, **kwargs: stub_client
+    ethereum_sc.instantiate_blockchain_handlers = ledger.instantiate_blockchain_handlers
+    cert_issuer.issue_certificates.issue = ledger.issue
+    sign_certificate.config = types.SimpleNamespace(**issuer_dirs)
+
+
+def load_sample_certificates():
+    with open(SAMPLE_CERTIFICATES) as f:
+        return json.load(f)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def rss_kib(pid):
+    try:
+        with open('/proc/%d/statm' % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def child_pids():
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                # The command name in parentheses may contain spaces, the parent pid follows the state after it
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if int(fields[1]) == os.getpid():
+            children.append(int(entry))
+    return children
+
+
+class RssSampler:
+    """
+    Polls the resident memory of this process and the sum over its children (the PDF render pool) while a scenario
+    runs. ru_maxrss would report the peak of the whole process lifetime, so every scenario after the largest one
+    would show the same value.
+    """
+
+    def __init__(self, interval_seconds=0.05):
+        self.interval_seconds = interval_seconds
+        self.peak_self = 0
+        self.peak_children = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        self.peak_self = max(self.peak_self, rss_kib(os.getpid()))
+        self.peak_children = max(self.peak_children, sum(rss_kib(pid) for pid in child_pids()))
+
+    def run(self):
+        while not self.stopped.wait(self.interval_seconds):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self.thread = threading.Thread(target=self.run, name='rss-sampler', daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+
+    def peak_rss_kib(self):
+        return {"self": self.peak_self, "children": self.peak_children}
+
+
+async def run_scenario(send_request, requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def timed_request(index):
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            response = await send_request(index)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                failures += 1
+
+    with RssSampler() as rss:
+        start = time.perf_counter()
+        await asyncio.gather(*[timed_request(index) for index in range(requests)])
+        elapsed = time.perf_counter() - start
+    return {
+        "requests": requests,
+        "failures": failures,
+        "seconds": elapsed,
+        "throughputRps": requests / elapsed,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "peakRssKiB": rss.peak_rss_kib(),
+    }
+
+
+async def benchmark(args):
+    from cert_tools import create_v3_alpha_certificate_template
+    from fastapi_simple_security import api_key_security
+    from controller.cert_tools import generate_unsigned_certificate
+    from controller.cert_tools import issuer_client as issuer_client_module
+    from controller.cert_tools.unsigned_certificates import load_certificate_template, instantiate_batch_in_memory
+
+    samples = load_sample_certificates()
+    ledger = FakeLedger(args.confirmation_latency, samples[0]['proof'])
+    conf = create_v3_alpha_certificate_template.get_config()
+    work_root = tempfile.mkdtemp(prefix='cert-api-bench-')
+    issuer_dirs = {
+        "unsigned_certificates_dir": generate_unsigned_certificate.get_unsigned_certificates_root(conf),
+        "signed_certificates_dir": join(work_root, 'signed_certificates'),
+        "blockchain_certificates_dir": join(work_root, 'blockchain_certificates'),
+        "work_dir": join(work_root, 'work'),
+    }
+    os.environ.setdefault("ISSUER_WORKSPACE_DIR", join(work_root, 'workspaces'))
+    install_fakes(ledger, issuer_dirs)
+
+    from controller.tools_application import app as tools_app
+    from controller.issuer_application import app as issuer_app
+    tools_app.dependency_overrides[api_key_security] = lambda: None
+
+    issuer_client = httpx.AsyncClient(app=issuer_app, base_url="http://cert_issuer_api")
+    tools_client = httpx.AsyncClient(app=tools_app, base_url="http://cert_tools_api")
+
+    create_v3_alpha_certificate_template.write_certificate_template(conf, PUBLIC_KEY)
+    template = load_certificate_template(conf)
+
+    def crids(batch_size):
+        return ['0x' + uuid.uuid4().hex * 2 for _ in range(batch_size)]
+
+    def create_request(batch_size, stream):
+        async def send(index):
+            payload = {"publicKey": PUBLIC_KEY, "crid": crids(batch_size), "cridType": "sha2-256",
+                       "enableIPFS": False, "metadataJson": "{\"authors\":\"Albert Einstein\"}"}
+            return await tools_client.post("/createBloxbergCertificate", params={"stream": stream}, json=payload,
+                                           timeout=None)
+        return send
+
+    def issue_request(batch_size):
+        async def send(index):
+            unsigned = instantiate_batch_in_memory(template, crids(batch_size), "sha2-256")
+            payload = {"recipientPublickey": PUBLIC_KEY, "unSignedCerts": list(unsigned),
+                       "unSignedCertificates": list(unsigned.values()), "enableIPFS": False}
+            return await issuer_client.post("/issueBloxbergCertificate", json=payload, timeout=None)
+        return send
+
+    def pdf_request(batch_size, stream):
+        payload = [samples[i % len(samples)] for i in range(batch_size)]
+
+        async def send(index):
+            return await tools_client.post("/generatePDF", params={"stream": stream}, json=payload, timeout=None)
+        return send
+
+    endpoints = {
+        "createBloxbergCertificate": lambda batch_size: create_request(batch_size, False),
+        "createBloxbergCertificate?stream=true": lambda batch_size: create_request(batch_size, True),
+        "issueBloxbergCertificate": issue_request,
+        "generatePDF": lambda batch_size: pdf_request(batch_size, False),
+        "generatePDF?stream=true": lambda batch_size: pdf_request(batch_size, True),
+    }
+
+    results = []
+    await tools_app.router.startup()
+    await issuer_app.router.startup()
+    # The tools service reaches the issuer in-process instead of over the network
+    await issuer_client_module.close_issuer_client()
+    issuer_client_module.client = httpx.AsyncClient(app=issuer_app, timeout=None)
+    try:
+        for endpoint in args.endpoints:
+            for batch_size in args.batch_sizes:
+                for concurrency in args.concurrency:
+                    transactions_before = ledger.transactions
+                    result = await run_scenario(endpoints[endpoint](batch_size), args.requests, concurrency)
+                    result.update({"endpoint": endpoint, "batchSize": batch_size, "concurrency": concurrency,
+                                   "transactions": ledger.transactions - transactions_before})
+                    results.append(result)
+                    print(f"{endpoint} batch={batch_size} concurrency={concurrency}: "
+                          f"{result['throughputRps']:.2f} req/s, p50={result['p50']:.3f}s p95={result['p95']:.3f}s "
+                          f"p99={result['p99']:.3f}s failures={result['failures']}")
+    finally:
+        await tools_app.router.shutdown()
+        await issuer_app.router.shutdown()
+        await tools_client.aclose()
+        await issuer_client.aclose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--endpoints', nargs='+',
+                        default=["createBloxbergCertificate", "createBloxbergCertificate?stream=true",
+                                 "issueBloxbergCertificate", "generatePDF", "generatePDF?stream=true"])
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 10, 100, 1000])
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 16])
+    parser.add_argument('--requests', type=int, default=16, help='requests per scenario')
+    parser.add_argument('--confirmation-latency', type=float, default=1.0,
+                        help='seconds the fake ledger takes to confirm a transaction')
+    args = parser.parse_args()
+
+    # Job workers would poll the queue during the measurements
+    os.environ.setdefault("JOB_WORKERS", "0")
+    results = asyncio.get_event_loop().run_until_complete(benchmark(args))
+    report = {
+        "created": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        "python": platform.python_version(),
+        "confirmationLatency": args.confirmation_latency,
+        "results": results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results written to ' + args.output)
+
+
+if __name__ == '__main__':
+    main()
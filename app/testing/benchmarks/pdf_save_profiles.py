@@ -0,0 +1,63 @@
+"""
+Compares the PDF save profiles of pdf_renderer on certificates from generate_pdf_1000.json.
+
+Run from the repository root with the cert_tools dependencies installed:
+
+    python -m app.testing.benchmarks.pdf_save_profiles --template ../cert-tools/bloxbergDataCertificate.pdf
+"""
+import argparse
+import json
+import sys
+import time
+from os.path import join, dirname, abspath
+
+import fitz
+from lds_merkle_proof_2019.merkle_proof_2019 import MerkleProof2019
+
+# The modules import each other as controller.*, the same layout as in the containers
+sys.path.insert(0, abspath(join(dirname(__file__), '..', '..')))
+
+from controller.cert_tools import pdf_renderer
+
+
+def load_certificates(count):
+    with open(join(dirname(__file__), '..', 'generate_pdf_1000.json')) as f:
+        return json.load(f)[:count]
+
+
+def benchmark_profile(profile, certificates, decodedProofs):
+    sizes = []
+    start = time.perf_counter()
+    for certificate, decodedProof in zip(certificates, decodedProofs):
+        content = json.dumps(certificate).encode('utf8')
+        sizes.append(len(pdf_renderer.buildPDFBytes(content, certificate, decodedProof, profile)))
+    elapsed = time.perf_counter() - start
+
+    # The embedded certificate has to survive every profile
+    content = json.dumps(certificates[0]).encode('utf8')
+    doc = fitz.open(stream=pdf_renderer.buildPDFBytes(content, certificates[0], decodedProofs[0], profile),
+                    filetype="pdf")
+    assert json.loads(doc.embeddedFileGet("bloxbergJSONCertificate")) == certificates[0]
+
+    return {"profile": profile, "certificates": len(certificates), "seconds": elapsed,
+            "msPerPdf": 1000 * elapsed / len(certificates), "meanBytes": sum(sizes) / len(sizes)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--template', default=pdf_renderer.TEMPLATE_PATH)
+    parser.add_argument('--count', type=int, default=200)
+    args = parser.parse_args()
+
+    pdf_renderer.TEMPLATE_PATH = args.template
+    certificates = load_certificates(args.count)
+    decodedProofs = [MerkleProof2019().decode(c['proof']['proofValue']) for c in certificates]
+    # Build the cached base document before timing
+    pdf_renderer.get_base_document()
+    for profile in pdf_renderer.SAVE_PROFILES:
+        result = benchmark_profile(profile, certificates, decodedProofs)
+        print(f"{result['profile']:>8}: {result['msPerPdf']:.2f} ms/PDF, {result['meanBytes'] / 1024:.1f} KiB/PDF")
+
+
+if __name__ == '__main__':
+    main()
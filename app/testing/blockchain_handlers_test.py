@@ -0,0 +1,82 @@
+import threading
+
+from app.controller.cert_issuer.blockchain_handlers import BlockchainHandlerPool, NonceManager
+
+
+class FakeConnector:
+    def __init__(self):
+        self.pending = 5
+
+    def get_address_nonce(self, address):
+        return self.pending
+
+
+class FakeTransactionHandler:
+    def __init__(self):
+        self.healthy = True
+
+    def ensure_balance(self):
+        if not self.healthy:
+            raise ConnectionError("RPC connection lost")
+
+
+def make_pool(size=2, health_check_seconds=60, nonce_manager=None):
+    built = []
+
+    def factory():
+        handlers = (object(), FakeTransactionHandler(), FakeConnector())
+        built.append(handlers)
+        return handlers
+    return BlockchainHandlerPool(factory, size, health_check_seconds, nonce_manager), built
+
+
+def test_handlers_are_reused():
+    pool, built = make_pool()
+    first = pool.acquire()
+    pool.release(first)
+    second = pool.acquire()
+    assert second is first
+    assert len(built) == 1
+
+
+def test_failed_handlers_are_rebuilt():
+    pool, built = make_pool()
+    pooled = pool.acquire()
+    pool.release(pooled, healthy=False)
+    assert pool.acquire() is not pooled
+    assert len(built) == 2
+
+
+def test_unhealthy_handlers_are_replaced_on_acquire():
+    pool, built = make_pool(health_check_seconds=0)
+    pooled = pool.acquire()
+    pooled.handlers[1].healthy = False
+    pool.release(pooled)
+    assert pool.acquire() is not pooled
+
+
+def test_pool_size_bounds_concurrent_handlers():
+    pool, built = make_pool(size=1)
+    pooled = pool.acquire()
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+    waiter.start()
+    waiter.join(0.1)
+    assert acquired == []
+    pool.release(pooled)
+    waiter.join(1)
+    assert acquired == [pooled]
+
+
+def test_concurrent_transactions_get_distinct_nonces():
+    nonce_manager = NonceManager()
+    connector = FakeConnector()
+    nonce_manager.wrap(connector)
+    address = "0xD748BF41264b906093460923169643f45BDbC32e"
+    assert [connector.get_address_nonce(address) for _ in range(3)] == [5, 6, 7]
+    # Once the chain is ahead again its nonce wins
+    connector.pending = 10
+    assert connector.get_address_nonce(address) == 10
+    nonce_manager.reset()
+    connector.pending = 8
+    assert connector.get_address_nonce(address) == 8
@@ -0,0 +1,64 @@
+import asyncio
+
+from app.controller.cert_tools.chunked_issuance import issue_chunks, split_chunks
+
+
+def test_split_chunks():
+    assert split_chunks(list(range(5)), 2) == [[0, 1], [2, 3], [4]]
+    assert split_chunks([], 1000) == []
+
+
+def test_chunks_are_pipelined_and_yielded_in_order():
+    in_flight = []
+    peak = []
+
+    async def issue_chunk(chunk):
+        in_flight.append(chunk)
+        peak.append(len(in_flight))
+        # Later chunks finish first
+        await asyncio.sleep(0.01 * (10 - chunk[0]))
+        in_flight.remove(chunk)
+        return [crid * 2 for crid in chunk]
+
+    async def run():
+        return [item async for item in issue_chunks(split_chunks(list(range(10)), 2), issue_chunk, concurrency=3)]
+
+    results = asyncio.run(run())
+    assert [index for index, chunk, result, error in results] == [0, 1, 2, 3, 4]
+    assert [result for index, chunk, result, error in results] == [[0, 2], [4, 6], [8, 10], [12, 14], [16, 18]]
+    assert max(peak) == 3
+
+
+def test_failed_chunk_does_not_stop_the_others():
+    async def issue_chunk(chunk):
+        if chunk == [2, 3]:
+            raise ConnectionError("transaction was not mined")
+        return chunk
+
+    async def run():
+        return [item async for item in issue_chunks(split_chunks(list(range(6)), 2), issue_chunk, concurrency=2)]
+
+    results = asyncio.run(run())
+    assert [result for index, chunk, result, error in results] == [[0, 1], None, [4, 5]]
+    assert isinstance(results[1][3], ConnectionError)
+
+
+def test_closing_early_cancels_chunks_in_flight():
+    started = []
+
+    async def issue_chunk(chunk):
+        started.append(chunk)
+        await asyncio.sleep(10)
+
+    async def run():
+        results = issue_chunks(split_chunks(list(range(10)), 1), issue_chunk, concurrency=2)
+        task = asyncio.ensure_future(results.__anext__())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await results.aclose()
+        await asyncio.sleep(0)
+        return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    assert asyncio.run(run()) == []
+    assert started == [[0], [1]]
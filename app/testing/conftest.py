@@ -0,0 +1,5 @@
+import sys
+from os.path import join, dirname, abspath
+
+# The services import their modules as controller.*, the same layout as in the containers
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
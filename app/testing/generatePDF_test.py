@@ -141,6 +141,23 @@ async def call_generate_pdf(session):
     return response
 
 
+@pytest.mark.asyncio
+async def test_extract_certificates_from_zip():
+    test_request_payload = _load_json_schema("./generate_pdf_1000.json")[:3]
+
+    url = "http://localhost:7000"
+    async with httpx.AsyncClient() as session:  # use httpx
+        pdf_response = await session.post(url + "/generatePDF", json=test_request_payload, timeout=None)
+        assert pdf_response.status_code == 200
+        files = {"files": ("bloxbergResearchCertificates.zip", pdf_response.content, "application/zip")}
+        response = await session.post(url + "/extractCertificates", files=files, timeout=None)
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) == 3
+    assert sorted(line["certificate"]["crid"] for line in lines) == \
+        sorted(certificate["crid"] for certificate in test_request_payload)
+
+
 def _load_json_schema(filename):
     """ Loads the given schema file """
 
@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+from app.controller.cert_tools.idempotency import IdempotencyConflict, IdempotencyStore, RequestDeduplicator, \
+    derive_key, hash_body, DONE, RUN, WAIT, STREAMED
+
+
+def test_concurrent_duplicates_share_one_execution(tmp_path):
+    deduplicator = RequestDeduplicator(IdempotencyStore(str(tmp_path / "keys.db")))
+    calls = []
+
+    async def certify():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return [{"crid": "0x01"}]
+
+    async def run():
+        return await asyncio.gather(*[deduplicator.run("key", "body", certify) for _ in range(3)])
+
+    assert asyncio.run(run()) == [[{"crid": "0x01"}]] * 3
+    assert len(calls) == 1
+
+
+def test_completed_result_is_replayed(tmp_path):
+    store = IdempotencyStore(str(tmp_path / "keys.db"))
+    deduplicator = RequestDeduplicator(store)
+
+    async def certify():
+        return [{"crid": "0x01"}]
+
+    async def fail():
+        raise AssertionError("the request must not run again")
+
+    asyncio.run(deduplicator.run("key", "body", certify))
+    assert asyncio.run(deduplicator.run("key", "body", fail)) == [{"crid": "0x01"}]
+    assert store.begin("key", "body") == (DONE, [{"crid": "0x01"}])
+
+
+def test_key_running_in_another_worker_is_awaited(tmp_path):
+    store = IdempotencyStore(str(tmp_path / "keys.db"))
+    deduplicator = RequestDeduplicator(store, poll_interval=0.01)
+    assert store.begin("key", "body") == (RUN, None)
+    assert store.begin("key", "body") == (WAIT, None)
+
+    async def run():
+        waiting = asyncio.ensure_future(deduplicator.run("key", "body", None))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        store.complete("key", ["certificate"])
+        return await waiting
+
+    assert asyncio.run(run()) == ["certificate"]
+
+
+def test_failures_are_not_replayed(tmp_path):
+    deduplicator = RequestDeduplicator(IdempotencyStore(str(tmp_path / "keys.db")))
+
+    async def fail():
+        raise ValueError("Certifying batch to the blockchain failed.")
+
+    async def certify():
+        return ["certificate"]
+
+    with pytest.raises(ValueError):
+        asyncio.run(deduplicator.run("key", "body", fail))
+    assert asyncio.run(deduplicator.run("key", "body", certify)) == ["certificate"]
+
+
+def test_reused_key_with_different_body_conflicts(tmp_path):
+    store = IdempotencyStore(str(tmp_path / "keys.db"))
+    store.begin("key", "body")
+    with pytest.raises(IdempotencyConflict):
+        asyncio.run(RequestDeduplicator(store).run("key", "other body", None))
+
+
+def test_expired_results_run_again(tmp_path):
+    store = IdempotencyStore(str(tmp_path / "keys.db"), ttl_seconds=-1)
+    store.begin("key", "body")
+    store.complete("key", ["certificate"])
+    assert store.begin("key", "body") == (RUN, None)
+
+
+async def certificates(*crids):
+    for crid in crids:
+        await asyncio.sleep(0)
+        yield {"crid": crid}
+
+
+async def collect(items):
+    return [item async for item in items]
+
+
+def test_streamed_request_completes_its_key(tmp_path):
+    store = IdempotencyStore(str(tmp_path / "keys.db"))
+    deduplicator = RequestDeduplicator(store, poll_interval=0.01)
+
+    async def run():
+        assert await deduplicator.claim("key", "body") == (RUN, None)
+        duplicate = asyncio.ensure_future(deduplicator.claim("key", "body"))
+        streamed = await collect(deduplicator.stream("key", certificates("0x01", "0x02")))
+        return streamed, await duplicate
+
+    streamed, duplicate = asyncio.run(run())
+    assert streamed == [{"crid": "0x01"}, {"crid": "0x02"}]
+    assert duplicate == (DONE, STREAMED)
+
+
+def test_failed_or_aborted_streams_release_their_key(tmp_path):
+    store = IdempotencyStore(str(tmp_path / "keys.db"))
+    deduplicator = RequestDeduplicator(store)
+
+    async def with_error_line():
+        store.begin("key", "body")
+        items = deduplicator.stream("key", certificates("0x01", "0x02"), failed=lambda item: item["crid"] == "0x01")
+        return await collect(items)
+
+    async def aborted():
+        store.begin("key", "body")
+        items = deduplicator.stream("key", certificates("0x01", "0x02"))
+        await items.__anext__()
+        await items.aclose()
+
+    assert len(asyncio.run(with_error_line())) == 2
+    assert store.begin("key", "body") == (RUN, None)
+    store.abandon("key")
+    asyncio.run(aborted())
+    assert store.begin("key", "body") == (RUN, None)
+
+
+def test_derived_keys():
+    body_hash = hash_body({"publicKey": "0x69575606E8b8F0cAaA5A3BD1fc5D032024Bb85AF", "crid": ["0x01"]})
+    assert body_hash == hash_body({"crid": ["0x01"], "publicKey": "0x69575606E8b8F0cAaA5A3BD1fc5D032024Bb85AF"})
+    assert derive_key("api key", None, body_hash) != derive_key("other api key", None, body_hash)
+    assert derive_key("api key", "retry-1", body_hash) == derive_key("api key", "retry-1", hash_body({}))
@@ -0,0 +1,147 @@
+import asyncio
+import time
+
+from app.controller.cert_issuer.ipns_publisher import IPNSPublisher, IPNSStore, AVAILABLE, FAILED, PENDING, \
+    PUBLISHED, RESERVED
+
+
+class FakeIPFSNode:
+    def __init__(self, failures=0):
+        self.keys = {}
+        self.published = {}
+        self.failures = failures
+
+    def generate_key(self, key_name):
+        self.keys[key_name] = 'k51' + key_name[-12:]
+        return self.keys[key_name]
+
+    def publish_name(self, key_name, ipfs_path):
+        if self.failures > 0:
+            self.failures -= 1
+            raise TimeoutError("IPNS publish timed out")
+        self.published[key_name] = ipfs_path
+
+
+def make_publisher(db_path, node, retries=3, stale_seconds=900.0, reserved_timeout=3600.0):
+    return IPNSPublisher(IPNSStore(str(db_path)), node.generate_key, node.publish_name, pool_size=2, retries=retries,
+                         retry_backoff=0, stale_seconds=stale_seconds, reserved_timeout=reserved_timeout)
+
+
+def test_claimed_keys_are_not_handed_out_twice(tmp_path):
+    store = IPNSStore(str(tmp_path / "ipns.db"))
+    store.add_key("first", "k51first")
+    store.add_key("second", "k51second")
+    assert store.claim_key() == ("first", "k51first")
+    assert store.claim_key() == ("second", "k51second")
+    assert store.claim_key() is None
+    assert store.get("k51first")["status"] == RESERVED
+
+
+def test_reserve_uses_pool_and_publishes_in_background(tmp_path):
+    node = FakeIPFSNode()
+
+    async def run():
+        publisher = make_publisher(tmp_path / "ipns.db", node)
+        publisher.start()
+        while publisher.store.available_keys() < 2:
+            await asyncio.sleep(0.01)
+        ipns_name = await publisher.reserve_name()
+        assert ipns_name in node.keys.values()
+        await publisher.publish(ipns_name, "QmManifest")
+        while (await publisher.status(ipns_name))["status"] != PUBLISHED:
+            await asyncio.sleep(0.01)
+        # The reserved key is replaced in the pool
+        while publisher.store.available_keys() < 2:
+            await asyncio.sleep(0.01)
+        await publisher.stop()
+
+    asyncio.run(run())
+    assert "/ipfs/QmManifest" in node.published.values()
+    assert len(node.keys) == 3
+
+
+def test_empty_pool_generates_key_for_the_batch(tmp_path):
+    node = FakeIPFSNode()
+    publisher = make_publisher(tmp_path / "ipns.db", node)
+    ipns_name = asyncio.run(publisher.reserve_name())
+    assert publisher.store.get(ipns_name)["status"] == RESERVED
+    assert publisher.store.get("k51unknown") is None
+
+
+def test_publish_retries_then_fails(tmp_path):
+    node = FakeIPFSNode(failures=5)
+    publisher = make_publisher(tmp_path / "ipns.db", node, retries=2)
+    publisher.store.add_key("batch", "k51batch", RESERVED)
+    asyncio.run(publisher.publish_with_retries("k51batch", "/ipfs/QmManifest"))
+    status = publisher.store.get("k51batch")
+    assert status["status"] == FAILED
+    assert status["attempts"] == 3
+    assert status["error"] == "IPNS publish timed out"
+
+
+def test_publish_succeeds_after_retry(tmp_path):
+    node = FakeIPFSNode(failures=1)
+    publisher = make_publisher(tmp_path / "ipns.db", node)
+    publisher.store.add_key("batch", "k51batch", AVAILABLE)
+    asyncio.run(publisher.publish_with_retries("k51batch", "/ipfs/QmManifest"))
+    assert publisher.store.get("k51batch")["status"] == PUBLISHED
+    assert node.published["batch"] == "/ipfs/QmManifest"
+
+
+def test_pending_publishes_of_a_restarted_worker_are_requeued(tmp_path):
+    node = FakeIPFSNode()
+    publisher = make_publisher(tmp_path / "ipns.db", node)
+    publisher.store.add_key("batch", "k51batch", RESERVED)
+    # The worker queued the publish and went away before it ran
+    asyncio.run(publisher.publish("k51batch", "QmManifest"))
+
+    async def run():
+        restarted = make_publisher(tmp_path / "ipns.db", node, stale_seconds=0.05)
+        restarted.start()
+        while (await restarted.status("k51batch"))["status"] == PENDING:
+            await asyncio.sleep(0.01)
+        await restarted.stop()
+
+    asyncio.run(run())
+    assert publisher.store.get("k51batch")["status"] == PUBLISHED
+    assert node.published["batch"] == "/ipfs/QmManifest"
+
+
+def test_stale_names_are_claimed_by_one_worker(tmp_path):
+    store = IPNSStore(str(tmp_path / "ipns.db"))
+    store.add_key("batch", "k51batch", RESERVED)
+    store.update("k51batch", PENDING, "/ipfs/QmManifest", 0)
+    assert store.claim_stale(PENDING, time.time() - 60) == []
+    assert store.claim_stale(PENDING, time.time() + 1) == [("k51batch", "/ipfs/QmManifest")]
+    assert store.claim_stale(PENDING, time.time() - 60) == []
+
+
+def test_names_of_failed_issuances_are_not_reused(tmp_path):
+    node = FakeIPFSNode()
+    publisher = make_publisher(tmp_path / "ipns.db", node)
+    publisher.store.add_key("batch", "k51batch", RESERVED)
+    publisher.store.add_key("published", "k51published", RESERVED)
+    publisher.store.update("k51published", PUBLISHED, "/ipfs/QmManifest", 1)
+
+    asyncio.run(publisher.abandon("k51batch", "The batch was not issued"))
+    asyncio.run(publisher.abandon("k51published", "The batch was not issued"))
+    status = publisher.store.get("k51batch")
+    assert status["status"] == FAILED
+    assert status["error"] == "The batch was not issued"
+    assert publisher.store.get("k51published")["status"] == PUBLISHED
+    assert publisher.store.claim_key() is None
+
+
+def test_names_reserved_for_too_long_are_marked_failed(tmp_path):
+    node = FakeIPFSNode()
+
+    async def run():
+        publisher = make_publisher(tmp_path / "ipns.db", node, reserved_timeout=0.05)
+        publisher.store.add_key("batch", "k51batch", RESERVED)
+        publisher.start()
+        while (await publisher.status("k51batch"))["status"] == RESERVED:
+            await asyncio.sleep(0.01)
+        await publisher.stop()
+        return await publisher.status("k51batch")
+
+    assert asyncio.run(run())["status"] == FAILED
@@ -0,0 +1,50 @@
+import asyncio
+
+from app.controller.cert_tools.job_queue import JobQueue, JobWorkerPool, FINISHED, FAILED, QUEUED, RUNNING
+
+
+def test_submit_claim_finish(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.db"))
+    job_id = queue.submit({"publicKey": "0x69575606E8b8F0cAaA5A3BD1fc5D032024Bb85AF", "crid": ["0x01"]})
+    assert queue.get(job_id)["status"] == QUEUED
+
+    claimed_id, payload = queue.claim()
+    assert claimed_id == job_id
+    assert payload["crid"] == ["0x01"]
+    assert queue.get(job_id)["status"] == RUNNING
+    # A running job is not handed out twice.
+    assert queue.claim() is None
+
+    queue.finish(job_id, [{"crid": "0x01"}])
+    job = queue.get(job_id)
+    assert job["status"] == FINISHED
+    assert job["result"] == [{"crid": "0x01"}]
+
+
+def test_jobs_are_claimed_in_submission_order(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.db"))
+    first = queue.submit({"n": 1})
+    second = queue.submit({"n": 2})
+    assert queue.claim()[0] == first
+    assert queue.claim()[0] == second
+
+
+def test_expired_lease_is_requeued(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.db"), lease_seconds=-1)
+    job_id = queue.submit({"n": 1})
+    queue.claim()
+    assert queue.claim()[0] == job_id
+
+
+def test_worker_records_failure(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.db"))
+    job_id = queue.submit({"n": 1})
+
+    async def handler(payload):
+        raise ValueError("Certifying batch to the blockchain failed.")
+
+    pool = JobWorkerPool(queue, handler, worker_count=1)
+    asyncio.run(pool.run_job(*queue.claim()))
+    job = queue.get(job_id)
+    assert job["status"] == FAILED
+    assert job["error"] == "Certifying batch to the blockchain failed."
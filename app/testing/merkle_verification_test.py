@@ -0,0 +1,63 @@
+import hashlib
+import json
+from app.controller.cert_tools.merkle_verification import MerklePathVerifier, check_certificates, hash_certificate, \
+    TARGET_HASH_MISMATCH, MERKLE_ROOT_MISMATCH, INVALID_CERTIFICATE
+
+
+def normalize(document):
+    return json.dumps(document, sort_keys=True)
+
+
+def parent(left, right):
+    return hashlib.sha256(bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+
+def issued_batch(count):
+    """ Certificates with proofs of a complete binary Merkle tree, like cert_issuer builds them. """
+    certificates = [{"crid": "0x%02x" % i, "proof": {"type": "MerkleProof2019"}} for i in range(count)]
+    level = [hash_certificate(certificate, normalize) for certificate in certificates]
+    paths = [[] for _ in certificates]
+    positions = list(range(count))
+    while len(level) > 1:
+        for index, position in enumerate(positions):
+            sibling = position ^ 1
+            paths[index].append({"right": level[sibling]} if position % 2 == 0 else {"left": level[sibling]})
+            positions[index] = position // 2
+        level = [parent(level[i], level[i + 1]) for i in range(0, len(level), 2)]
+    decodedProofs = [{"targetHash": hash_certificate(certificate, normalize), "path": path, "merkleRoot": level[0],
+                      "anchors": ["blink:eth:bloxberg:0xabc"]} for certificate, path in zip(certificates, paths)]
+    return certificates, decodedProofs
+
+
+def test_valid_batch_is_verified():
+    certificates, decodedProofs = issued_batch(8)
+    assert check_certificates(certificates, decodedProofs, normalize) == [None] * 8
+
+
+def test_shared_nodes_are_hashed_once():
+    certificates, decodedProofs = issued_batch(8)
+    verifier = MerklePathVerifier()
+    for certificate, decodedProof in zip(certificates, decodedProofs):
+        assert verifier.root(decodedProof["targetHash"], decodedProof["path"]) == decodedProof["merkleRoot"]
+    assert len(verifier.nodes) == 7
+
+
+def test_modified_certificate_fails():
+    certificates, decodedProofs = issued_batch(4)
+    certificates[1]["crid"] = "0xff"
+    assert check_certificates(certificates, decodedProofs, normalize) == [None, TARGET_HASH_MISMATCH, None, None]
+
+
+def test_wrong_path_fails():
+    certificates, decodedProofs = issued_batch(4)
+    decodedProofs[2]["path"] = decodedProofs[3]["path"]
+    decodedProofs[3]["merkleRoot"] = "00" * 32
+    assert check_certificates(certificates, decodedProofs, normalize) == \
+        [None, None, MERKLE_ROOT_MISMATCH, MERKLE_ROOT_MISMATCH]
+
+
+def test_malformed_proof_fails():
+    certificates, decodedProofs = issued_batch(2)
+    del decodedProofs[0]["targetHash"]
+    decodedProofs[1]["path"] = [{"up": "00"}]
+    assert check_certificates(certificates, decodedProofs, normalize) == [INVALID_CERTIFICATE, INVALID_CERTIFICATE]
@@ -0,0 +1,39 @@
+from app.controller.cert_tools.result_cache import CertificateResultCache, hash_metadata
+
+PUBLIC_KEY = "0x69575606E8b8F0cAaA5A3BD1fc5D032024Bb85AF"
+
+
+def certificate(crid):
+    return {"crid": crid, "cridType": "sha2-256", "proof": {"proofValue": "z" + crid}}
+
+
+def test_lookup_returns_only_certified_crids(tmp_path):
+    cache = CertificateResultCache(str(tmp_path / "cache.db"))
+    metadata_hash = hash_metadata({"authors": "Albert Einstein"})
+    cache.store(PUBLIC_KEY, "sha2-256", metadata_hash, [certificate("0x01"), certificate("0x02")], ["0xabc", "0xabc"])
+
+    found = cache.lookup(PUBLIC_KEY, ["0x01", "0x03", "0x02"], "sha2-256", metadata_hash)
+    assert found == {"0x01": certificate("0x01"), "0x02": certificate("0x02")}
+
+
+def test_key_includes_public_key_crid_type_and_metadata(tmp_path):
+    cache = CertificateResultCache(str(tmp_path / "cache.db"))
+    metadata_hash = hash_metadata(None)
+    cache.store(PUBLIC_KEY, "sha2-256", metadata_hash, [certificate("0x01")])
+
+    assert cache.lookup("0x0000000000000000000000000000000000000000", ["0x01"], "sha2-256", metadata_hash) == {}
+    assert cache.lookup(PUBLIC_KEY, ["0x01"], None, metadata_hash) == {}
+    assert cache.lookup(PUBLIC_KEY, ["0x01"], "sha2-256", hash_metadata({"authors": "Albert Einstein"})) == {}
+    assert cache.lookup(PUBLIC_KEY, ["0x01"], "sha2-256", metadata_hash) == {"0x01": certificate("0x01")}
+
+
+def test_metadata_hash_ignores_key_order():
+    assert hash_metadata({"a": 1, "b": 2}) == hash_metadata({"b": 2, "a": 1})
+    assert hash_metadata({"a": 1}) != hash_metadata({"a": 2})
+
+
+def test_lookup_of_large_batches(tmp_path):
+    cache = CertificateResultCache(str(tmp_path / "cache.db"))
+    crids = ["0x%04x" % i for i in range(1200)]
+    cache.store(PUBLIC_KEY, "sha2-256", "", [certificate(crid) for crid in crids])
+    assert len(cache.lookup(PUBLIC_KEY, crids, "sha2-256", "")) == 1200
@@ -0,0 +1,70 @@
+import json
+import os
+from app.controller.cert_tools.template_cache import TemplateCache
+
+PUBLIC_KEY = "0x69575606E8b8F0cAaA5A3BD1fc5D032024Bb85AF"
+OTHER_KEY = "0x0000000000000000000000000000000000000000"
+
+
+class Renderer:
+    def __init__(self, directory):
+        self.directory = directory
+        self.rendered = []
+
+    def __call__(self, public_key, file_name):
+        self.rendered.append(public_key)
+        with open(os.path.join(self.directory, file_name), 'w') as f:
+            json.dump({"issuer": "bloxberg", "recipient": public_key}, f)
+
+
+def test_template_is_rendered_once_per_public_key(tmp_path):
+    render = Renderer(str(tmp_path))
+    cache = TemplateCache(str(tmp_path), render, "abc")
+
+    template, file_name = cache.get(PUBLIC_KEY)
+    assert cache.get(PUBLIC_KEY) == (template, file_name)
+    assert template == {"issuer": "bloxberg", "recipient": PUBLIC_KEY}
+    assert render.rendered == [PUBLIC_KEY]
+    with open(os.path.join(str(tmp_path), file_name)) as f:
+        assert json.load(f) == template
+    assert sorted(os.listdir(str(tmp_path))) == [file_name]
+
+
+def test_keys_and_configs_get_their_own_files(tmp_path):
+    render = Renderer(str(tmp_path))
+    cache = TemplateCache(str(tmp_path), render, "abc")
+    other_config = TemplateCache(str(tmp_path), render, "def")
+
+    assert cache.get(PUBLIC_KEY)[1] != cache.get(OTHER_KEY)[1]
+    assert cache.get(PUBLIC_KEY)[1] != other_config.get(PUBLIC_KEY)[1]
+
+
+def test_least_recently_used_template_is_evicted(tmp_path):
+    render = Renderer(str(tmp_path))
+    cache = TemplateCache(str(tmp_path), render, "abc", max_size=1, persist=False)
+
+    cache.get(PUBLIC_KEY)
+    cache.get(OTHER_KEY)
+    cache.get(PUBLIC_KEY)
+    assert render.rendered == [PUBLIC_KEY, OTHER_KEY, PUBLIC_KEY]
+
+
+def test_persisted_templates_are_loaded_by_other_workers(tmp_path):
+    render = Renderer(str(tmp_path))
+    TemplateCache(str(tmp_path), render, "abc").get(PUBLIC_KEY)
+
+    restarted = TemplateCache(str(tmp_path), render, "abc")
+    assert restarted.get(PUBLIC_KEY)[0] == {"issuer": "bloxberg", "recipient": PUBLIC_KEY}
+    assert render.rendered == [PUBLIC_KEY]
+
+
+def test_removed_file_is_written_again(tmp_path):
+    render = Renderer(str(tmp_path))
+    cache = TemplateCache(str(tmp_path), render, "abc")
+    template, file_name = cache.get(PUBLIC_KEY)
+    os.remove(os.path.join(str(tmp_path), file_name))
+
+    cache.get(PUBLIC_KEY)
+    with open(os.path.join(str(tmp_path), file_name)) as f:
+        assert json.load(f) == template
+    assert render.rendered == [PUBLIC_KEY]
@@ -0,0 +1,37 @@
+from app.controller.cert_tools.unsigned_certificates import instantiate_batch_in_memory
+
+template = {
+    "@context": [
+        "https://www.w3.org/2018/credentials/v1",
+        "https://w3id.org/bloxberg/schema/research_object_certificate_v1"
+    ],
+    "type": ["VerifiableCredential", "BloxbergCredential"],
+    "issuer": "https://raw.githubusercontent.com/bloxberg-org/issuer_json/master/issuer.json",
+    "credentialSubject": {
+        "id": "https://blockexplorer.bloxberg.org/address/0x69575606E8b8F0cAaA5A3BD1fc5D032024Bb85AF",
+        "issuingOrg": {"id": "https://bloxberg.org"}
+    },
+    "id": "https://bloxberg.org"
+}
+
+
+def test_one_certificate_per_crid_in_order():
+    crids = ["0x0e4ded5319861c8daac00d425c53a16bd180a7d01a340a0e00f7dede40d2c9f6",
+             "0xfda3124d5319861c8daac00d425c53a16bd180a7d01a340a0e00f7dede40d2c9f6"]
+    certificates = instantiate_batch_in_memory(template, crids, "sha2-256", {"authors": "Albert Einstein"})
+    assert len(set(certificates)) == 2
+    assert [certificate["crid"] for certificate in certificates.values()] == crids
+    for certificate in certificates.values():
+        assert certificate["cridType"] == "sha2-256"
+        assert certificate["metadataJson"] == "{\"authors\": \"Albert Einstein\"}"
+        assert certificate["credentialSubject"] == template["credentialSubject"]
+        assert "issuanceDate" in certificate
+    # The template itself is left untouched
+    assert "crid" not in template
+
+
+def test_optional_fields_are_omitted():
+    certificates = instantiate_batch_in_memory(template, ["0x01"])
+    certificate = next(iter(certificates.values()))
+    assert "cridType" not in certificate
+    assert "metadataJson" not in certificate